@@ -46,6 +46,8 @@ if st.button("Generate Report"):
         for comment in result.get("comments", []):
             st.text(comment)
         st.success(result.get("message"))
+        if result.get("job_id"):
+            st.text(f"Job id: {result['job_id']} (progress at /reports/{result['job_id']})")
     else:
         st.error("Error occurred during report generation.")
 
@@ -0,0 +1,137 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+PAGE_SIZE = 1000
+
+
+class _Paginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = self.client._keys(Bucket, Prefix)
+        for start in range(0, len(keys), PAGE_SIZE):
+            yield {'Contents': [self.client._head(Bucket, key) for key in keys[start:start + PAGE_SIZE]],
+                   'KeyCount': len(keys[start:start + PAGE_SIZE])}
+
+
+class LocalS3Client:
+    # Stand-in for the subset of the boto3 S3 client the report pipeline uses, backed by
+    # a directory: s3://bucket/key lives at {root}/bucket/key. For benchmarks and local runs only.
+    # get_latency adds a delay to every GET, and more than max_concurrent_gets GETs in flight are
+    # answered with SlowDown (503) like a busy S3 prefix.
+
+    def __init__(self, root, get_latency=0.0, max_concurrent_gets=None):
+        self.root = root
+        self.get_requests = 0
+        self.get_latency = get_latency
+        self.max_concurrent_gets = max_concurrent_gets
+        self.throttled_gets = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Map workers of the parallel pipeline get a copy with their own lock and counters
+        return dict(self.__dict__, _lock=None, _in_flight=0, get_requests=0, throttled_gets=0)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def _path(self, bucket_name, key):
+        return os.path.join(self.root, bucket_name, *key.split('/'))
+
+    def _keys(self, bucket_name, prefix):
+        bucket_root = os.path.join(self.root, bucket_name)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def _etag(self, path):
+        # S3 ETags of single part uploads are the quoted MD5 of the body, size + mtime is enough here
+        stat = os.stat(path)
+        return '"' + hashlib.md5(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest() + '"'
+
+    def _head(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        stat = os.stat(path)
+        return {
+            'Key': key,
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+            'ETag': self._etag(path),
+            'Size': stat.st_size,
+        }
+
+    def _no_such_key(self, operation, key):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f'{key} does not exist'}}, operation)
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return _Paginator(self)
+
+    def list_objects_v2(self, Bucket, Prefix=''):
+        pages = list(_Paginator(self).paginate(Bucket, Prefix))
+        return pages[0] if pages else {'KeyCount': 0}
+
+    def _slow_down(self):
+        return ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+                            'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        with self._lock:
+            self.get_requests += 1
+            self._in_flight += 1
+            throttled = self.max_concurrent_gets is not None and self._in_flight > self.max_concurrent_gets
+            if throttled:
+                self.throttled_gets += 1
+        try:
+            if self.get_latency:
+                time.sleep(self.get_latency)
+            if throttled:
+                raise self._slow_down()
+            with open(path, 'rb') as object_file:
+                body = object_file.read()
+        except FileNotFoundError:
+            raise self._no_such_key('GetObject', Key)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        return {'Body': io.BytesIO(body), 'ETag': self._etag(path), 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key):
+        try:
+            return self._head(Bucket, Key)
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as object_file:
+            object_file.write(Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': self._etag(path)}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as object_file:
+            shutil.copyfileobj(Fileobj, object_file)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return 'file://' + self._path(Params['Bucket'], Params['Key'])
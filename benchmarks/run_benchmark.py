@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+
+# Runs from the repository root: python -m benchmarks.run_benchmark
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic_sessions import write_sessions
+
+BOT_ID = 'benchmark-bot'
+START_DATE = '2024-01-01'
+END_DATE = '2024-01-07'
+# Sessions are spread over the 7 days of the report window
+DATA_END = datetime(2024, 1, 8)
+# Compacted shards go through the local bucket too, so their reads pay the same simulated latency
+SHARD_BUCKET = 'benchmark-shards'
+SHARD_LOCATION = f's3://{SHARD_BUCKET}/compacted'
+
+
+def prepare_data(workdir, count, other_bots):
+    # Generated session objects are kept between runs, keyed by size and bot mix
+    root = os.path.join(workdir, f'sessions-{count}-{other_bots}')
+    marker = os.path.join(root, '.complete')
+    if not os.path.exists(marker):
+        shutil.rmtree(root, ignore_errors=True)
+        print(f'Generating {count} synthetic sessions in {root}')
+        bot_ids = [BOT_ID] + [f'other-bot-{i}' for i in range(other_bots)]
+        write_sessions(root, 'core-session-prod', count, bot_ids, DATA_END)
+        open(marker, 'w').close()
+    return root
+
+
+def compact_data(data_root, state_dir):
+    # Roll the generated sessions into per-day shards the way the scheduled compaction does,
+    # with an index and cache of its own so the report runs still start cold
+    from benchmarks.local_s3 import LocalS3Client
+    from session_cache import SessionCache
+    from session_index import load_session_index
+    from session_shards import ShardStore, compact_sessions
+
+    shutil.rmtree(os.path.join(data_root, SHARD_BUCKET), ignore_errors=True)
+    s3_client = LocalS3Client(data_root)
+    cache = SessionCache(os.path.join(state_dir, 'compaction_cache'))
+    session_index = load_session_index(s3_client, 'core-session-prod', 'expired/',
+                                       location=os.path.join(state_dir, 'compaction_index.json'), cache=cache)
+    compact_sessions(ShardStore(SHARD_LOCATION, s3_client), session_index, s3_client, 'core-session-prod',
+                     cache=cache)
+    shutil.rmtree(os.path.join(state_dir, 'compaction_cache'))
+
+
+def run_single(data_root):
+    # One report run against the local bucket, prints its result as the last JSON line.
+    # Runs in its own process so the session index and cache locations and the peak
+    # memory belong to this run alone.
+    from benchmarks.local_s3 import LocalS3Client
+    from report_engine import run_report
+
+    def no_email(*args, **kwargs):
+        pass
+
+    # Simulated GET latency and S3 throttling, see --get-latency and --throttle-above
+    max_concurrent_gets = os.environ.get('BENCHMARK_THROTTLE_ABOVE')
+    s3_client = LocalS3Client(data_root, float(os.environ.get('BENCHMARK_GET_LATENCY', '0')),
+                              int(max_concurrent_gets) if max_concurrent_gets else None)
+    result = run_report(START_DATE, END_DATE, BOT_ID, 'Benchmark', [], 'benchmark@example.com',
+                        s3_client=s3_client, send_email=no_email, job_id='benchmark')
+    result['get_requests'] = s3_client.get_requests
+    result['throttled_gets'] = s3_client.throttled_gets
+    if 'map_reduce' in result['timings']:
+        # Map workers read through copies of the client, their GETs are only in the job's read counts
+        result['get_requests'] = result['timings']['s3_reads']['requests']
+        result['throttled_gets'] = result['timings']['s3_reads']['throttles']
+    print(json.dumps(result))
+
+
+def run_case(data_root, state_dir, count, label, report_cache, shards=False):
+    env = dict(os.environ,
+               SESSION_INDEX_LOCATION=os.path.join(state_dir, 'session_index.json'),
+               SESSION_CACHE_DIR=os.path.join(state_dir, 'session_cache'),
+               REPORT_CACHE_LOCATION=os.path.join(state_dir, report_cache),
+               SESSION_ROLLUP_LOCATION=os.path.join(state_dir, 'rollups'),
+               SESSION_SHARD_LOCATION=SHARD_LOCATION if shards else os.path.join(state_dir, 'shards'))
+    completed = subprocess.run([sys.executable, '-m', 'benchmarks.run_benchmark', '--single', data_root],
+                               cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stdout)
+        print(completed.stderr)
+        raise RuntimeError(f'Benchmark run {count}/{label} failed')
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    timings = result['timings']
+    total_wall = timings['total_wall_s']
+
+    return {
+        'objects': count,
+        'run': label,
+        'sessions': result['sessions'],
+        'cached': result['cached'],
+        'get_requests': result['get_requests'],
+        'throttled_gets': result['throttled_gets'],
+        's3_reads': timings.get('s3_reads'),
+        'map_reduce': timings.get('map_reduce'),
+        'total_wall_s': total_wall,
+        'sessions_per_s': round(count / total_wall, 1) if total_wall else None,
+        'peak_rss_mb': max((s['peak_rss_mb'] or 0) for s in timings['stages']),
+        'stages': {s['stage']: {'wall_s': s['wall_s'], 'cpu_s': s['cpu_s'], 'peak_rss_mb': s['peak_rss_mb'],
+                                'sessions_per_s': round(count / s['wall_s'], 1) if s['wall_s'] else None}
+                   for s in timings['stages']},
+    }
+
+
+def print_table(results):
+    stage_names = []
+    for result in results:
+        for name in result['stages']:
+            if name not in stage_names:
+                stage_names.append(name)
+
+    header = ['objects', 'run', 'total_s', 'sess/s', 'peak_mb'] + [f'{name}_s' for name in stage_names]
+    print(' '.join(f'{column:>10}' for column in header))
+    for result in results:
+        row = [result['objects'], result['run'], result['total_wall_s'], result['sessions_per_s'],
+               result['peak_rss_mb']]
+        row += [result['stages'].get(name, {}).get('wall_s', '') for name in stage_names]
+        print(' '.join(f'{str(value):>10}' for value in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end and per-stage timings of the report pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of session objects in the bucket')
+    parser.add_argument('--other-bots', type=int, default=0,
+                        help='Extra bots sharing the bucket, their sessions are listed but not reported')
+    parser.add_argument('--workdir', default='/tmp/report_benchmark')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--get-latency', type=float, default=0.0, help='Seconds added to every GetObject')
+    parser.add_argument('--throttle-above', type=int,
+                        help='Answer GetObject with SlowDown while more than this many are in flight')
+    parser.add_argument('--shards', action='store_true',
+                        help='Compact the sessions into per-day shards before the runs')
+    parser.add_argument('--pipeline', choices=['streaming', 'parallel', 'frame'],
+                        help='REPORT_PIPELINE_MODE of the runs (the environment\'s by default)')
+    parser.add_argument('--map-workers', type=int, help='REPORT_MAP_WORKERS of the parallel pipeline')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single)
+        return
+
+    # Passed on to the run processes
+    os.environ['BENCHMARK_GET_LATENCY'] = str(args.get_latency)
+    if args.throttle_above is not None:
+        os.environ['BENCHMARK_THROTTLE_ABOVE'] = str(args.throttle_above)
+    if args.pipeline:
+        os.environ['REPORT_PIPELINE_MODE'] = args.pipeline
+    if args.map_workers is not None:
+        os.environ['REPORT_MAP_WORKERS'] = str(args.map_workers)
+
+    results = []
+    for count in args.sizes:
+        data_root = prepare_data(args.workdir, count, args.other_bots)
+        state_dir = os.path.join(args.workdir, f'state-{count}-{args.other_bots}')
+        shutil.rmtree(state_dir, ignore_errors=True)
+        os.makedirs(state_dir)
+        if args.shards:
+            compact_data(data_root, state_dir)
+
+        # Cold: no session index, cache or stored rollups yet. Indexed: a new container, the stored
+        # index and rollups are current but the local session cache is empty. Warm: the index, rollups
+        # and session cache left by the earlier runs. Repeat: the same report again, served from the
+        # finished report cache.
+        for label, report_cache in [('cold', 'report_cache_cold'), ('indexed', 'report_cache_indexed'),
+                                    ('warm', 'report_cache'), ('repeat', 'report_cache')]:
+            if label == 'indexed':
+                shutil.rmtree(os.path.join(state_dir, 'session_cache'), ignore_errors=True)
+            result = run_case(data_root, state_dir, count, label, report_cache, args.shards)
+            print(json.dumps(result))
+            results.append(result)
+
+    print_table(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs from the repository root: python -m benchmarks.startup_benchmark
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.run_benchmark import BOT_ID, END_DATE, START_DATE, prepare_data
+
+METRICS = ['import_s', 'first_invocation_s', 'warm_invocation_s', 'cached_invocation_s']
+
+
+def run_single(data_root, state_dir):
+    # What a fresh Lambda container goes through: import the report engine, run one report
+    # (cold), run a second one in the same process (warm), then repeat it unchanged (cached).
+    # manual_dashboard_lambda itself also needs the deployment's secret module, the engine is
+    # everything it imports on top of that.
+    started = time.perf_counter()
+    import report_engine
+    import_s = time.perf_counter() - started
+
+    from benchmarks.local_s3 import LocalS3Client
+    from report_cache import ReportResultCache
+
+    def no_email(*args, **kwargs):
+        pass
+
+    s3_client = LocalS3Client(data_root)
+    timings = {'import_s': import_s}
+    for metric, cache_dir in [('first_invocation_s', 'first'), ('warm_invocation_s', 'warm'),
+                              ('cached_invocation_s', 'warm')]:
+        started = time.perf_counter()
+        report_engine.run_report(START_DATE, END_DATE, BOT_ID, 'Benchmark', [], 'benchmark@example.com',
+                                 s3_client=s3_client, send_email=no_email,
+                                 result_cache=ReportResultCache(os.path.join(state_dir, cache_dir)))
+        timings[metric] = time.perf_counter() - started
+
+    print(json.dumps(timings))
+
+
+# The engine and the modules it imports lazily on the first report
+PIPELINE_MODULES = ['report_engine', 'extract_data', 'create_visualisations', 'excel_export', 'report_pdf']
+
+
+def module_import_times():
+    # Cumulative import time of each pipeline module and of what it imports directly,
+    # in import order (later modules do not repeat what earlier ones already loaded)
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(PIPELINE_MODULES)],
+                               cwd=REPO_ROOT, capture_output=True, text=True)
+    modules = []
+    children = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        module = {'module': name.strip(), 'depth': depth, 'seconds': round(int(cumulative) / 1e6, 3)}
+
+        # -X importtime lists a module after everything it imported
+        if depth == 1 and module['seconds'] >= 0.01:
+            children.append(module)
+        elif depth == 0:
+            if module['module'] in PIPELINE_MODULES:
+                modules += children + [module]
+            children = []
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time and first/warm invocation latency of the report engine')
+    parser.add_argument('--sessions', type=int, default=1000, help='Number of session objects in the bucket')
+    parser.add_argument('--repeats', type=int, default=3, help='Fresh processes to take the median over')
+    parser.add_argument('--workdir', default='/tmp/report_benchmark')
+    parser.add_argument('--single', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(*args.single)
+        return
+
+    data_root = prepare_data(args.workdir, args.sessions, 0)
+
+    runs = []
+    for _ in range(args.repeats):
+        # Every process starts without a session index, session cache or report cache
+        with tempfile.TemporaryDirectory() as state_dir:
+            env = dict(os.environ,
+                       SESSION_INDEX_LOCATION=os.path.join(state_dir, 'session_index.json'),
+                       SESSION_CACHE_DIR=os.path.join(state_dir, 'session_cache'))
+            completed = subprocess.run([sys.executable, '-m', 'benchmarks.startup_benchmark',
+                                        '--single', data_root, state_dir],
+                                       cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stdout)
+            print(completed.stderr)
+            raise RuntimeError('Startup benchmark run failed')
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    result = {metric: round(statistics.median(run[metric] for run in runs), 3) for metric in METRICS}
+    print(json.dumps(result))
+
+    print(f"{'module':<40} {'import_s':>9}")
+    for module in module_import_times():
+        print(f"{'  ' * module['depth'] + module['module']:<40} {module['seconds']:>9}")
+
+
+if __name__ == '__main__':
+    main()
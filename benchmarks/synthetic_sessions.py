@@ -0,0 +1,86 @@
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+SPEAKERS = ['user', 'bot']
+COMPONENT_NAMES = ['Housing Assistance', 'Food Pantry', 'Crisis Line', 'Legal Aid', 'Job Training',
+                   'Medical Clinic', 'Transportation', 'Utility Assistance', 'Child Care', 'Senior Services']
+UTTERANCES = ['I need help paying rent this month', 'Where is the nearest food bank?',
+              'Can someone call me back tomorrow?', 'What documents do I need to apply?',
+              'Here are a few services that may help you.', 'Is there anything else I can help with?']
+
+
+def generate_session(rng, bot_id, created_at):
+    # One session document with the same shape the report decodes from core-session-prod
+    turns = []
+    for turn in range(rng.randint(1, 12)):
+        turns.append({
+            'speaker': SPEAKERS[turn % 2],
+            'utterance': [rng.choice(UTTERANCES) for _ in range(rng.randint(1, 3))],
+            'created_at': created_at + turn * 15000,
+        })
+
+    query_results = [{
+        '_index': 'components',
+        '_score': round(rng.uniform(0.3, 1.0), 3),
+        '_source': {
+            'component_id': str(rng.randint(1000, 9999)),
+            'component_name': rng.choice(COMPONENT_NAMES),
+            'component_type': 'service',
+        },
+    } for _ in range(rng.randint(0, 6))]
+
+    fail_turn_indices = sorted(rng.sample(range(len(turns)), rng.randint(0, min(2, len(turns)))))
+
+    return {
+        'session_id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'account_id': 'account-1',
+        'referrer': 'https://example.org/help',
+        'bot_name': 'Benchmark Bot',
+        'bot_id': bot_id,
+        'is_billable': True,
+        'is_test': False,
+        'created_at': created_at,
+        'history': {'turns': turns},
+        'config': {
+            'semantic_search': {'confidence_threshold': 60},
+            'online_learning': {'utterance_auto_add_threshold_lower': 40, 'utterance_auto_add_threshold_upper': 80},
+            'fail_mechanism': {'max_consecutive_fails': 3},
+        },
+        'state': {
+            'fail_counter': len(fail_turn_indices),
+            'fail_turn_indices': fail_turn_indices,
+            'report_indices': [0] if rng.random() < 0.05 else [],
+            'email_triggers': [1] if rng.random() < 0.03 else [],
+            'component_state': {'query_results': query_results},
+        },
+    }
+
+
+def write_sessions(root, bucket_name, count, bot_ids, end_date, days=7, interim_share=0.05, seed=0):
+    # Write `count` session objects spread over `days` days before end_date into a LocalS3Client
+    # root. Object mtimes are set to the session's last activity so LastModified filtering works.
+    rng = random.Random(seed)
+    end_epoch = end_date.timestamp()
+    span = timedelta(days=days).total_seconds()
+
+    for i in range(count):
+        created_at = int((end_epoch - rng.uniform(0, span)) * 1000)
+        session = generate_session(rng, rng.choice(bot_ids), created_at)
+        prefix = 'interim' if rng.random() < interim_share else 'expired'
+
+        path = os.path.join(root, bucket_name, prefix, f'{session["session_id"]}.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as session_file:
+            json.dump(session, session_file)
+
+        last_activity = session['history']['turns'][-1]['created_at'] / 1000
+        os.utime(path, (last_activity, last_activity))
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.synthetic_sessions ROOT COUNT
+    import sys
+    write_sessions(sys.argv[1], 'core-session-prod', int(sys.argv[2]), ['benchmark-bot'], datetime.utcnow())
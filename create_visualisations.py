@@ -1,10 +1,11 @@
 import plotly.graph_objects as go
 import plotly.express as px
-import pandas as pd
 import plotly.io as pio
-import ast
 import base64
 
+from report_metrics import compute_report_metrics
+
+
 def generate_html_report_images(figure_titles, figures, start_date, end_date):
     # Define the HTML template
     html_template = """
@@ -120,16 +121,9 @@ def generate_html_report(figure_titles, figures, start_date, end_date):
 
 
 
-def plot_component_frequencies_horizontal(df):
-    # Convert string representations of dictionaries to actual dictionaries
-    df['component_info1'] = df['component_info'].apply(ast.literal_eval)
-    
-    # Flatten the list of dictionaries in the 'component_info' column
-    components = [component for row in df['component_info1'] for component in row]
-    
-    # Create a DataFrame with component names and their frequencies
-    component_df = pd.DataFrame(components)
-    component_counts = component_df['component_name'].value_counts().reset_index()
+def component_frequencies_figure(component_name_counts):
+    # Component name -> frequency, most frequent first
+    component_counts = component_name_counts.sort_values(ascending=False, kind='stable').reset_index()
     component_counts.columns = ['Component Name', 'Frequency']
     
     # Create a bar chart using Plotly
@@ -140,11 +134,8 @@ def plot_component_frequencies_horizontal(df):
     return fig
 
 def plot_component_frequencies(df):
-    # Convert string representations of dictionaries to actual dictionaries
-    df['component_info1'] = df['component_info'].apply(ast.literal_eval)
-    
     # Extract component IDs and names from the 'component_info' column
-    component_info = df['component_info1'].explode()
+    component_info = df['component_info'].explode()
     component_ids = component_info.apply(lambda x: x.get('component_id'))
     component_names = component_info.apply(lambda x: x.get('component_name'))
 
@@ -160,16 +151,10 @@ def plot_component_frequencies(df):
     return fig
 
 
-def plot_sessions_by_hour(df):
-    # Convert 'created_at_date_central' and 'created_at_time_central' to datetime
-    df['created_at_date_central'] = pd.to_datetime(df['created_at_date_central'], format='%Y-%m-%d')
-    df['created_at_time_central'] = pd.to_datetime(df['created_at_time_central'], format='%H:%M:%S.%f').dt.time
-
-    # Group the data by hour and count the number of sessions
-    sessions_by_hour = df.groupby(df['created_at_time_central'].apply(lambda x: x.hour))['session_id'].count().reset_index()
-
+def sessions_by_hour_figure(session_counts_by_hour):
     # Sort the data by hour
-    sessions_by_hour = sessions_by_hour.sort_values('created_at_time_central')
+    sessions_by_hour = session_counts_by_hour.rename_axis('created_at_time_central').rename('session_id')
+    sessions_by_hour = sessions_by_hour.reset_index().sort_values('created_at_time_central')
 
     # Plot the graph
     fig = px.bar(
@@ -177,7 +162,7 @@ def plot_sessions_by_hour(df):
         x='created_at_time_central', 
         y='session_id', 
         labels={'created_at_time_central': 'Hour', 'session_id': 'Number of Sessions'},
-        category_orders={'created_at_time_central': sorted(df['created_at_time_central'].unique())}
+        category_orders={'created_at_time_central': sorted(sessions_by_hour['created_at_time_central'].unique())}
     )
 
     # Customize the axis labels and title
@@ -216,102 +201,30 @@ def plot_sessions_by_hour(df):
     return fig
 
 
-def create_total_failures_plot(df):
-    # Calculate total number of failures
-    total_failures = df['fail_counter'].sum()
+# Titles of the single number indicator plots
+INDICATOR_TITLES = {
+    'total_failures': 'Total Number of Failures that occured in the sessions throughout the given timeline',
+    'report_count': 'Total Number of Reports that were reported throughout the given timeline',
+    'trigger_count': 'Total Number of Email Triggers that were triggered throughout the given timeline',
+    'average_max_consecutive_fails': 'Average Value of Maximum Consecutive Fails for your bot configuration',
+    'total_sessions': 'Total Number of Sessions through the defined timeline',
+    'total_turns': 'Total number of Turns performed by the bot through the defined timeline',
+    'average_session_length': 'Average Session Length (in number of turns) of the bot during the defined timeline',
+}
 
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=total_failures))
-
-    # Update the layout
-    fig.update_layout(title='Total Number of Failures that occured in the sessions throughout the given timeline')
-
-    return fig
-
-
-def create_total_reports_indicator_plot(df):
-    # Count the number of non-empty values in 'report_indices' column
-    report_count = df['report_indices'].apply(lambda x: 1 if x != '[]' else 0).sum()
 
+def indicator_figure(value, title):
     # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=report_count))
+    fig = go.Figure(go.Indicator(mode='number', value=value))
 
     # Update the layout
-    fig.update_layout(title='Total Number of Reports that were reported throughout the given timeline')
+    fig.update_layout(title=title)
 
     return fig
 
-def create_total_triggers_indicator_plot(df):
-    # Count the number of non-empty values in 'email_triggers' column
-    trigger_count = df['email_triggers'].apply(lambda x: 1 if x != '[]' else 0).sum()
-
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=trigger_count))
-
-    # Update the layout
-    fig.update_layout(title='Total Number of Email Triggers that were triggered throughout the given timeline')
-
-    return fig
-
-
-
-def create_average_max_consecutive_fails_plot(df):
-    # Calculate average value of maximum consecutive fails
-    average_max_consecutive_fails = df['max_consecutive_fails'].mean()
-
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=average_max_consecutive_fails))
-
-    # Update the layout
-    fig.update_layout(title='Average Value of Maximum Consecutive Fails for your bot configuration')
-
-    return fig
 
-
-
-def create_total_sessions_indicator_plot(df):
-    # Calculate total number of sessions in the entire week
-    total_sessions = df['session_id'].nunique()
-
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=total_sessions))
-
-    # Update the layout
-    fig.update_layout(title='Total Number of Sessions through the defined timeline')
-
-    return fig
-
-def create_total_turns_indicator_plot(df):
-    # Calculate total number of turns in the entire week
-    total_turns = df['turns'].sum()
-
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=total_turns))
-
-    # Update the layout
-    fig.update_layout(title='Total number of Turns performed by the bot through the defined timeline')
-
-    return fig
-
-
-def create_average_session_length_indicator_plot(df):
-    # Calculate average session length throughout the week
-    average_session_length = df.groupby('session_id')['turns'].sum().mean()
-
-    # Create the indicator plot
-    fig = go.Figure(go.Indicator(mode='number', value=average_session_length))
-
-    # Update the layout
-    fig.update_layout(title='Average Session Length (in number of turns) of the bot during the defined timeline')
-
-    return fig
-
-
-
-
-def generate_turns_bar_graph(df):
-    # Calculate the total count of turns per day
-    turn_counts = df.groupby('created_at_date')['turns'].sum().reset_index()
+def turns_per_day_figure(turns_per_day):
+    turn_counts = turns_per_day.rename_axis('created_at_date').rename('turns').reset_index()
 
     # Bar Graph
     bar_graph = px.bar(turn_counts, x='created_at_date', y='turns',
@@ -339,9 +252,8 @@ def generate_turns_bar_graph(df):
     return bar_graph
 
 
-def generate_session_bar_graph(df):
-    # Calculate the count of unique sessions per day
-    session_counts = df.groupby('created_at_date')['session_id'].nunique().reset_index()
+def sessions_per_day_figure(sessions_per_day):
+    session_counts = sessions_per_day.rename_axis('created_at_date').rename('session_id').reset_index()
 
     # Bar Graph
     bar_graph = px.bar(session_counts, x='created_at_date', y='session_id',
@@ -369,10 +281,7 @@ def generate_session_bar_graph(df):
     return bar_graph
 
 
-def generate_gauge_chart(df):
-    # Calculate the average values for lower and upper thresholds
-    lower_threshold = df['auto_add_threshold_lower'].mean()
-    upper_threshold = df['auto_add_threshold_upper'].mean()
+def threshold_gauge_figure(confidence_threshold, lower_threshold, upper_threshold):
 
     # Define the color scale for the gauge chart
     colorscale = [[0, 'lightgray'], [lower_threshold / 100, 'lightgray'],
@@ -382,7 +291,7 @@ def generate_gauge_chart(df):
     # Gauge Chart
     gauge_chart = go.Figure(go.Indicator(
         mode='gauge+number',
-        value=df['confidence_threshold'].mean(),
+        value=confidence_threshold,
         domain={'x': [0, 1], 'y': [0, 1]},
         gauge={
             'axis': {'range': [0, 100]},
@@ -394,7 +303,7 @@ def generate_gauge_chart(df):
             'threshold': {
                 'line': {'color': 'black', 'width': 2},
                 'thickness': 0.75,
-                'value': df['confidence_threshold'].mean()
+                'value': confidence_threshold
             },
             'bgcolor': 'white',
             'bar': {'color': 'rgb(55, 83, 109)'}
@@ -416,9 +325,8 @@ def generate_gauge_chart(df):
     return gauge_chart
 
 
-def generate_bar_chart_freq_turns(df):
-    # Calculate the count of each number of turns
-    turn_counts = df['turns'].value_counts().sort_index()
+def turns_distribution_figure(turn_value_counts):
+    turn_counts = turn_value_counts.sort_index()
 
     # Bar Chart
     bar_chart = go.Figure(data=go.Bar(x=turn_counts.index, y=turn_counts))
@@ -440,9 +348,8 @@ def generate_bar_chart_freq_turns(df):
 
     return bar_chart
 
-def generate_line_chart(df):
-    # Calculate average number of turns per day
-    average_turns = df.groupby('created_at_date')['turns'].mean().reset_index()
+def average_turns_per_day_figure(average_turns_per_day):
+    average_turns = average_turns_per_day.rename_axis('created_at_date').rename('turns').reset_index()
 
     # Line Chart
     line_chart = go.Figure()
@@ -464,9 +371,8 @@ def generate_line_chart(df):
     return line_chart
 
 
-def generate_stacked_bar_chart(df):
-    # Preprocess the data and sort the turns within each stack
-    turn_counts = df.groupby(['created_at_date', 'turns']).size().unstack().fillna(0)
+def conversation_lengths_figure(turn_counts):
+    # Sort the turns within each stack
     sorted_turns = turn_counts.columns.sort_values().tolist()
     turn_counts = turn_counts.reindex(columns=sorted_turns)
 
@@ -510,3 +416,30 @@ def generate_stacked_bar_chart(df):
 
     return stacked_bar_chart
 
+
+def build_report_figures(df):
+    # The report figures, in report order, from the session frame
+    return build_figures_from_metrics(compute_report_metrics(df))
+
+
+def build_figures_from_metrics(metrics):
+    # The report figures, in report order, from a ReportMetrics. The chart functions
+    # above only format the metrics, none of them looks at the sessions again.
+    return [
+        indicator_figure(metrics.total_sessions, INDICATOR_TITLES['total_sessions']),
+        indicator_figure(metrics.total_turns, INDICATOR_TITLES['total_turns']),
+        sessions_per_day_figure(metrics.sessions_per_day),
+        sessions_by_hour_figure(metrics.sessions_by_hour),
+        average_turns_per_day_figure(metrics.average_turns_per_day),
+        turns_per_day_figure(metrics.turns_per_day),
+        turns_distribution_figure(metrics.turn_counts),
+        conversation_lengths_figure(metrics.turns_by_day),
+        component_frequencies_figure(metrics.component_counts),
+        threshold_gauge_figure(metrics.confidence_threshold, metrics.auto_add_threshold_lower,
+                               metrics.auto_add_threshold_upper),
+        indicator_figure(metrics.average_session_length, INDICATOR_TITLES['average_session_length']),
+        indicator_figure(metrics.total_failures, INDICATOR_TITLES['total_failures']),
+        indicator_figure(metrics.report_count, INDICATOR_TITLES['report_count']),
+        indicator_figure(metrics.trigger_count, INDICATOR_TITLES['trigger_count']),
+        indicator_figure(metrics.average_max_consecutive_fails, INDICATOR_TITLES['average_max_consecutive_fails']),
+    ]
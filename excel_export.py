@@ -0,0 +1,294 @@
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from datetime import date, datetime, time, timedelta
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+# 'streaming' writes rows one at a time with conversations and components on their own
+# sheets, 'legacy' is the single sheet pandas export with list columns as strings
+DEFAULT_EXCEL_MODE = os.environ.get('EXCEL_EXPORT_MODE', 'streaming')
+
+# Longest text Excel keeps in one cell
+EXCEL_CELL_LIMIT = 32767
+# Most rows Excel opens in one sheet, header included. Longer sheets continue on 'Conversations 2', ...
+EXCEL_ROW_LIMIT = 1048576
+
+SESSION_SHEET_COLUMNS = ['session_id', 'bot_name', 'turns', 'created_at_date_central', 'created_at_time_central',
+                         'fail_counter', 'report_indices']
+# utterance_index numbers a session's utterances in order. A history turn can hold several
+# utterances, so it is not the turn number counted in the Sessions sheet's turns.
+CONVERSATION_SHEET_COLUMNS = ['session_id', 'utterance_index', 'speaker', 'utterance']
+COMPONENT_SHEET_COLUMNS = ['session_id', 'component_id', 'component_name']
+
+SHEET_TITLES = ['Sessions', 'Conversations', 'Components']
+SHEET_COLUMNS = [SESSION_SHEET_COLUMNS, CONVERSATION_SHEET_COLUMNS, COMPONENT_SHEET_COLUMNS]
+
+LEGACY_COLUMNS = ['session_id', 'bot_name', 'turns', 'created_at_date_central', 'created_at_time_central',
+                  'fail_counter', 'report_indices', 'user_conversation', 'component_info']
+LEGACY_LIST_COLUMNS = ['report_indices', 'user_conversation', 'component_info']
+
+# Values openpyxl writes with a number format, i.e. a cell style. Registered up front in this order
+# so a workbook and the fragments spliced into it number their styles the same way.
+STYLED_VALUES = [date(2000, 1, 1), datetime(2000, 1, 1), time(), timedelta()]
+
+# Row and cell references of sheet XML (<row r="12">, <c r="B12">), openpyxl writes strings inline
+# so they are the only part of a row that depends on where it lands in the sheet
+_ROW_REFERENCE_RE = re.compile(rb'<(row|c) r="([A-Z]*)([0-9]+)"')
+_ROW_START_RE = re.compile(rb'<row r="([0-9]+)"')
+
+
+class _CellWriter:
+    # Makes values safe for a cell and counts how many texts had to be cut to the limit
+
+    def __init__(self):
+        self.truncated = 0
+
+    def __call__(self, value):
+        if isinstance(value, list):
+            value = str(value)
+        if isinstance(value, str):
+            # Control characters are not allowed in XLSX and make openpyxl raise
+            value = ILLEGAL_CHARACTERS_RE.sub('', value)
+            if len(value) > EXCEL_CELL_LIMIT:
+                self.truncated += 1
+                value = value[:EXCEL_CELL_LIMIT]
+        return value
+
+
+def session_sheet_rows(df, cell):
+    # Cell safe rows of the Sessions, Conversations and Components sheets for the sessions of df
+    sessions = [[cell(value) for value in row]
+                for row in df[SESSION_SHEET_COLUMNS].itertuples(index=False, name=None)]
+
+    conversations = []
+    for session_id, conversation in zip(df['session_id'], df['user_conversation']):
+        # Sessions without utterances hold a single empty entry
+        for index, entry in enumerate((entry for entry in conversation if entry), start=1):
+            conversations.append([cell(session_id), index, cell(entry.get('speaker')), cell(entry.get('utterance'))])
+
+    components = []
+    for session_id, component_info in zip(df['session_id'], df['component_info']):
+        for entry in component_info:
+            if entry:
+                components.append([cell(session_id), cell(entry.get('component_id')),
+                                   cell(entry.get('component_name'))])
+
+    return sessions, conversations, components
+
+
+class SessionWorkbookWriter:
+    # write_only workbooks keep no rows in memory, each appended row goes straight to the
+    # sheet's temporary file. Conversations and components get one row per entry instead
+    # of one cell holding the whole list. Frames can be appended in chunks, or sheet fragments
+    # rendered elsewhere (SheetFragmentWriter) spliced in after them. A sheet that reaches
+    # EXCEL_ROW_LIMIT continues on a new one with the same header.
+
+    def __init__(self):
+        self.workbook = Workbook(write_only=True)
+        self.cell = _CellWriter()
+        # The worksheet each sheet's rows currently go to, and its rows so far (header included)
+        self.sheets = [None, None, None]
+        self.rows = [0, 0, 0]
+        self.continued = 0
+        # Rows of spliced in fragments by worksheet title
+        self.spliced = {}
+        for sheet in range(len(SHEET_TITLES)):
+            self._next_sheet(sheet)
+        _register_styles(self.sheets[0])
+
+    def _next_sheet(self, sheet):
+        # 'Conversations 2' goes right after 'Conversations', so each sheet's continuations stay together
+        same = [i for i, title in enumerate(self.workbook.sheetnames) if title.split(' ')[0] == SHEET_TITLES[sheet]]
+        if same:
+            worksheet = self.workbook.create_sheet(f'{SHEET_TITLES[sheet]} {len(same) + 1}', same[-1] + 1)
+            self.continued += 1
+        else:
+            worksheet = self.workbook.create_sheet(SHEET_TITLES[sheet])
+        worksheet.append(SHEET_COLUMNS[sheet])
+        self.sheets[sheet] = worksheet
+        self.rows[sheet] = 1
+
+    def append(self, df):
+        for sheet, rows in enumerate(session_sheet_rows(df, self.cell)):
+            while rows:
+                if self.rows[sheet] == EXCEL_ROW_LIMIT:
+                    self._next_sheet(sheet)
+                fitting = rows[:EXCEL_ROW_LIMIT - self.rows[sheet]]
+                worksheet = self.sheets[sheet]
+                for row in fitting:
+                    worksheet.append(row)
+                self.rows[sheet] += len(fitting)
+                rows = rows[len(fitting):]
+
+    def append_fragment(self, path, rows, truncated=0):
+        # Add the rows of a saved SheetFragmentWriter (rows per sheet), renumbered to follow the rows
+        # so far. Appending frames again afterwards is not supported. The fragment can be deleted.
+        with zipfile.ZipFile(path) as fragment:
+            for name in fragment.namelist():
+                sheet = _sheet_index(name)
+                if sheet is None or not rows[sheet]:
+                    continue
+                # Fragment row n lands on row n + offset of the current worksheet
+                offset = self.rows[sheet]
+                with fragment.open(name) as rows_file:
+                    for block in _sheet_rows(rows_file):
+                        while block:
+                            # Fragment rows up to `last` fit on the current worksheet
+                            last = EXCEL_ROW_LIMIT - offset
+                            cut = _row_position(block, last + 1)
+                            if cut:
+                                self._spliced_file(self.sheets[sheet].title).write(_renumber_rows(block[:cut], offset))
+                            block = block[cut:]
+                            if block:
+                                # Fragment row last + 1 becomes row 2 of the next worksheet, below its header
+                                self._next_sheet(sheet)
+                                offset = 1 - last
+                self.rows[sheet] = rows[sheet] + offset
+        self.cell.truncated += truncated
+
+    def _spliced_file(self, title):
+        if title not in self.spliced:
+            self.spliced[title] = tempfile.TemporaryFile()
+        return self.spliced[title]
+
+    def save(self, excel_file):
+        if self.spliced:
+            self._save_spliced(excel_file)
+        else:
+            self.workbook.save(excel_file)
+
+        if self.cell.truncated:
+            print(f'{self.cell.truncated} cells cut to the Excel limit of {EXCEL_CELL_LIMIT} characters')
+        if self.continued:
+            print(f'{self.continued} sheets continued on a new one at the Excel limit of {EXCEL_ROW_LIMIT} rows')
+
+    def _save_spliced(self, excel_file):
+        # Every part of the workbook comes from openpyxl, the spliced rows are only added to the end
+        # of each sheet's <sheetData>
+        titles = self.workbook.sheetnames
+        with tempfile.TemporaryFile() as base_file:
+            self.workbook.save(base_file)
+            with zipfile.ZipFile(base_file) as base, zipfile.ZipFile(excel_file, 'w', zipfile.ZIP_DEFLATED) as target:
+                for info in base.infolist():
+                    data = base.read(info)
+                    position = _sheet_index(info.filename)
+                    spliced = self.spliced.get(titles[position]) if position is not None else None
+                    if spliced is None:
+                        target.writestr(info, data)
+                        continue
+
+                    head, tail = data.split(b'</sheetData>')
+                    with target.open(info, 'w', force_zip64=True) as sheet_file:
+                        sheet_file.write(head)
+                        spliced.seek(0)
+                        shutil.copyfileobj(spliced, sheet_file)
+                        sheet_file.write(b'</sheetData>' + tail)
+
+        for spliced in self.spliced.values():
+            spliced.close()
+
+
+class SheetFragmentWriter:
+    # The sheet rows of appended frames, rendered by openpyxl into a workbook of their own without
+    # headers. Lets another process do the rendering, SessionWorkbookWriter.append_fragment adds
+    # the rows to the real workbook. Fragments are never opened in Excel, so their sheets are not
+    # held to EXCEL_ROW_LIMIT: append_fragment splits them wherever the workbook's sheets fill up.
+
+    def __init__(self, path):
+        self.path = path
+        self.cell = _CellWriter()
+        self.workbook = Workbook(write_only=True)
+        self.sheets = [self.workbook.create_sheet(title) for title in SHEET_TITLES]
+        _register_styles(self.sheets[0])
+        self.rows = [0, 0, 0]
+
+    def append(self, df):
+        for i, rows in enumerate(session_sheet_rows(df, self.cell)):
+            for row in rows:
+                self.sheets[i].append(row)
+            self.rows[i] += len(rows)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+def _register_styles(sheet):
+    # A cell's style is added to the workbook when its style_id is first read
+    for value in STYLED_VALUES:
+        WriteOnlyCell(sheet, value).style_id
+
+
+def _sheet_index(name):
+    # Position of a worksheet part in the workbook (xl/worksheets/sheet1.xml is the first sheet)
+    match = re.fullmatch(r'xl/worksheets/sheet([0-9]+)\.xml', name)
+    return int(match.group(1)) - 1 if match else None
+
+
+def _renumber_rows(data, offset):
+    return _ROW_REFERENCE_RE.sub(lambda match: b'<%s r="%s%d"' % (match.group(1), match.group(2),
+                                                                  int(match.group(3)) + offset), data)
+
+
+def _row_position(block, row):
+    # Where the first row numbered `row` or later starts in a block of <row> elements
+    last = block.rfind(b'<row r="')
+    if last == -1 or int(_ROW_START_RE.match(block, last).group(1)) < row:
+        return len(block)
+    for match in _ROW_START_RE.finditer(block):
+        if int(match.group(1)) >= row:
+            return match.start()
+
+
+def _sheet_rows(sheet_file, block_size=1024 * 1024):
+    # The <row> elements of a worksheet XML stream, block by block
+    pending = b''
+    started = False
+    while True:
+        block = sheet_file.read(block_size)
+        pending += block
+        if not started:
+            start = pending.find(b'<sheetData>')
+            if start == -1:
+                if not block:
+                    return
+                continue
+            pending = pending[start + len(b'<sheetData>'):]
+            started = True
+
+        end = pending.find(b'</sheetData>')
+        if end != -1:
+            yield pending[:end]
+            return
+        cut = pending.rfind(b'</row>')
+        if cut != -1:
+            cut += len(b'</row>')
+            yield pending[:cut]
+            pending = pending[cut:]
+        if not block:
+            return
+
+
+def _write_streaming(df, excel_file):
+    writer = SessionWorkbookWriter()
+    writer.append(df)
+    writer.save(excel_file)
+
+
+def _write_legacy(df, excel_file):
+    df_selected_excel = df[LEGACY_COLUMNS].copy()
+    for column in LEGACY_LIST_COLUMNS:
+        df_selected_excel[column] = df_selected_excel[column].astype(str)
+    df_selected_excel.to_excel(excel_file, index=False)
+
+
+def write_sessions_workbook(df, excel_file, mode=DEFAULT_EXCEL_MODE):
+    # Write the session export of a report to excel_file (a path or file object)
+    if mode == 'legacy':
+        _write_legacy(df, excel_file)
+    else:
+        _write_streaming(df, excel_file)
@@ -0,0 +1,82 @@
+import atexit
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import plotly.io as pio
+
+# Number of renderer processes, each with its own warm kaleido instance
+DEFAULT_RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', str(os.cpu_count() or 1)))
+
+# Kept alive for the life of the process so later jobs skip kaleido start up
+_render_pool = None
+_render_pool_workers = None
+
+
+def _warm_up():
+    # Start this worker's kaleido subprocess before the first real figure arrives
+    pio.to_image({'data': [], 'layout': {}}, format='png', width=10, height=10)
+
+
+def _render(figure, image_format, width, height, scale):
+    started = time.perf_counter()
+    image = pio.to_image(figure, format=image_format, width=width, height=height, scale=scale)
+    return image, time.perf_counter() - started
+
+
+def _get_render_pool(max_workers):
+    global _render_pool, _render_pool_workers
+    if _render_pool is None or _render_pool_workers != max_workers:
+        shutdown_renderer()
+        try:
+            # spawn, not fork: the parent may still hold boto3/thread locks from the fetch stage
+            _render_pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_warm_up,
+                                               mp_context=multiprocessing.get_context('spawn'))
+            _render_pool_workers = max_workers
+        except OSError as e:
+            # AWS Lambda has no /dev/shm, so multiprocessing pools cannot be created there
+            print(f'Render pool unavailable, rendering in process ({e})')
+            return None
+    return _render_pool
+
+
+def shutdown_renderer():
+    global _render_pool, _render_pool_workers
+    if _render_pool is not None:
+        _render_pool.shutdown()
+        _render_pool = None
+        _render_pool_workers = None
+
+
+atexit.register(shutdown_renderer)
+
+
+def render_figures(figures, image_format='png', width=1700, height=600, scale=2, max_workers=DEFAULT_RENDER_WORKERS):
+    # Rasterise figures concurrently, one kaleido per worker process.
+    # Returns the images in figure order and a timing record per figure.
+    figure_dicts = [fig.to_dict() for fig in figures]
+    pool = _get_render_pool(max_workers) if max_workers > 1 else None
+
+    started = time.perf_counter()
+    results = None
+    if pool is not None:
+        try:
+            futures = [pool.submit(_render, figure, image_format, width, height, scale) for figure in figure_dicts]
+            results = [future.result() for future in futures]
+        except BrokenProcessPool as e:
+            # A renderer died (e.g. killed for memory). Drop the pool so later reports start a new
+            # one, and render this report in process.
+            print(f'Render pool broken, rendering in process ({e})')
+            shutdown_renderer()
+    if results is None:
+        results = [_render(figure, image_format, width, height, scale) for figure in figure_dicts]
+
+    images = [image for image, _ in results]
+    timings = [{'figure': i + 1, 'seconds': round(seconds, 3), 'bytes': len(image)}
+               for i, (image, seconds) in enumerate(results)]
+    print(f'rendered {len(images)} figures in {time.perf_counter() - started:.2f}s '
+          f'(slowest {max(t["seconds"] for t in timings) if timings else 0:.2f}s)')
+
+    return images, timings
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+# Where finished report results are remembered, either a local directory or s3://bucket/prefix.
+# Use an S3 location when reports are generated from more than one machine or from Lambda.
+DEFAULT_REPORT_CACHE_LOCATION = os.environ.get('REPORT_CACHE_LOCATION', '/tmp/report_cache')
+
+
+def data_watermark(objects):
+    # Latest LastModified of the session objects in the report range. Indexed objects carry
+    # naive UTC timestamps and listed ones aware timestamps, so compare them naive.
+    if not objects:
+        return None
+    return max(obj['LastModified'].replace(tzinfo=None) for obj in objects).isoformat()
+
+
+def report_cache_key(bot_id, start_date, end_date, objects):
+    # A report only changes when a session in its range is written or removed, so the
+    # parameters plus the watermark and object count identify its content
+    fingerprint = json.dumps([bot_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+                              data_watermark(objects), len(objects)])
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+class ReportResultCache:
+    # Remembers the uploaded artifact keys of finished reports so an unchanged range
+    # is only e-mailed again instead of being rebuilt
+
+    def __init__(self, location=DEFAULT_REPORT_CACHE_LOCATION):
+        self.location = location
+
+    def _s3_location(self, cache_key):
+        bucket_name, _, prefix = self.location[len('s3://'):].partition('/')
+        return bucket_name, f"{prefix.rstrip('/')}/{cache_key}.json".lstrip('/')
+
+    def get(self, cache_key, s3_client, report_bucket):
+        try:
+            if self.location.startswith('s3://'):
+                bucket_name, key = self._s3_location(cache_key)
+                body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+            else:
+                with open(os.path.join(self.location, f'{cache_key}.json'), 'rb') as cache_file:
+                    body = cache_file.read()
+        except FileNotFoundError:
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return None
+
+        entry = json.loads(body)
+
+        # Artifacts removed from the report bucket (e.g. by a lifecycle rule) cannot be reused
+        for artifact_key in entry['artifacts'].values():
+            try:
+                s3_client.head_object(Bucket=report_bucket, Key=artifact_key)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+                print(f'Cached report artifact {artifact_key} is gone, rebuilding the report')
+                return None
+
+        return entry
+
+    def put(self, cache_key, s3_client, sessions, artifacts, watermark):
+        body = json.dumps({
+            'sessions': sessions,
+            'artifacts': artifacts,
+            'watermark': watermark,
+            'created_at': datetime.utcnow().isoformat(),
+        }).encode('utf-8')
+
+        if self.location.startswith('s3://'):
+            bucket_name, key = self._s3_location(cache_key)
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        else:
+            os.makedirs(self.location, exist_ok=True)
+            # Write then rename so a concurrent reader never sees half an entry
+            path = os.path.join(self.location, f'{cache_key}.json')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(body)
+            os.replace(tmp_path, path)
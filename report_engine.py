@@ -0,0 +1,442 @@
+import json
+import os
+import tempfile
+import traceback
+from datetime import datetime, timedelta
+
+from report_cache import ReportResultCache, data_watermark, report_cache_key
+from s3_fetcher import FetchStats, get_s3_client, list_all_objects, objects_in_range
+from s3_uploader import ArtifactUploads
+from send_mail import send_email_with_attachments
+from session_cache import CacheStats, get_session_cache
+from session_index import load_session_index
+from session_shards import ShardReader, ShardStore
+from stage_timer import StageTimer
+
+SESSION_BUCKET = 'core-session-prod'
+PREFIX_EXPIRED = 'expired/'
+PREFIX_INTERIM = 'interim/'
+REPORT_BUCKET = 'weekly-reports-risos'
+REGION = 'us-east-1'
+
+# Artifacts are built in memory and only spill to a private temporary file past this size
+ARTIFACT_SPOOL_BYTES = int(os.environ.get('ARTIFACT_SPOOL_BYTES', str(64 * 1024 * 1024)))
+# A batch holds the CSV and XLSX of every bot until each is published, so they spill much sooner
+BATCH_ARTIFACT_SPOOL_BYTES = int(os.environ.get('BATCH_ARTIFACT_SPOOL_BYTES', str(1024 * 1024)))
+
+
+def report_file_key(bot_id, start_date, end_date, extension):
+    # One folder per bot, so reports of different bots for the same week never overwrite each other
+    return (f"{bot_id}/analytics_report_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}"
+            f".{extension}")
+
+
+def artifact_buffer(max_size=ARTIFACT_SPOOL_BYTES):
+    # Private to the job, so concurrent reports never share a file
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+def notify_report(send_email, sender_email, recipients, bot_id, name_of_bot_user, start_date, end_date,
+                  artifacts, include_bot_id=False):
+    subject = f'Analytics report for {name_of_bot_user} - Ask alden bot'
+    text_body = (f"Hello! Here are the reports of your {name_of_bot_user} - Ask alden bot for the requested "
+                 f"timeline {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}.")
+    if include_bot_id:
+        text_body += f" [Bot ID : {bot_id}]"
+    send_email(sender_email, recipients, subject, text_body, REPORT_BUCKET, [artifacts['pdf'], artifacts['xlsx']],
+               REGION)
+
+
+class ReportTarget:
+    # One bot's report: who it is for and how the bot is named in the e-mail
+
+    def __init__(self, bot_id, name_of_bot_user, recipients):
+        self.bot_id = bot_id
+        self.name_of_bot_user = name_of_bot_user
+        self.recipients = recipients
+
+
+def _report_dates(start_date_dashboard, end_date_dashboard):
+    start_date = datetime.strptime(start_date_dashboard, "%Y-%m-%d")
+    end_date_original = datetime.strptime(end_date_dashboard, "%Y-%m-%d")
+    end_date = end_date_original + timedelta(days=1)
+    print(start_date, ' to ', end_date)
+    return start_date, end_date_original, end_date
+
+
+def _list_report_objects(s3_client, bot_ids, start_date, end_date, cache, stats):
+    # Expired sessions never change, so they are looked up in the bot_id/date index
+    # and only the bots' keys are downloaded. Interim sessions are still being written
+    # to, so that prefix is listed in full. Returns the expired objects per bot and
+    # the interim objects, all already cut to the date range, and the ShardReader that
+    # downloads them (from compacted shards where there are any).
+    session_index = load_session_index(s3_client, SESSION_BUCKET, PREFIX_EXPIRED, cache=cache, stats=stats,
+                                       since=start_date)
+    expired = {bot_id: objects_in_range(session_index.objects_for(bot_id, start_date, end_date), start_date, end_date)
+               for bot_id in bot_ids}
+    interim = objects_in_range(list_all_objects(s3_client, SESSION_BUCKET, PREFIX_INTERIM), start_date, end_date)
+    print(f'{sum(len(objects) for objects in expired.values()) + len(interim)} session objects in range')
+    return expired, interim, ShardReader(ShardStore(s3_client=s3_client), session_index, bot_ids)
+
+
+def _report_decode_failures(decode_failures):
+    # Report sessions that could not be decoded instead of failing the whole report
+    if decode_failures:
+        print(json.dumps({'malformed_sessions': len(decode_failures), 'errors': decode_failures[:20]}))
+
+
+def _parse_sessions(timer, s3_client, shards, objects, bot_id_filter, cache, stats, conversations):
+    # pandas is only loaded once a report actually has to be built
+    from extract_data import decode_sessions
+
+    # Downloads are decoded as they arrive, the time spent waiting on them is the fetch stage.
+    # Conversations go to the ConversationStore until the export reads them back.
+    bodies = shards.fetch(s3_client, SESSION_BUCKET, objects, cache, stats)
+    df = decode_sessions(timer.timed_iter('fetch', bodies), bot_id_filter, conversations)
+    print(f'{len(df)} sessions extracted')
+
+    _report_decode_failures(df.attrs['decode_failures'])
+    return df
+
+
+def _report_rollups(s3_client, shards, expired):
+    # Which of the bots' sessions are charted from stored daily rollups (ReportRollups)
+    from session_rollups import ReportRollups, RollupStore
+    return ReportRollups(RollupStore(s3_client=s3_client), shards.session_index, expired)
+
+
+def _stream_sessions(timer, s3_client, shards, rollups, objects, bot_id_filter, cache, stats, new_stream=None):
+    # Decode downloads in chunks as they arrive and fold every chunk into its bot's report
+    # stream right away, so memory depends on the download window and the chunk size rather
+    # than on the number of sessions. Returns {bot_id: BotReportStream} of bots with sessions.
+    from report_stream import STREAM_CHUNK_SESSIONS
+    from session_rollups import decode_rollup_chunks
+
+    if new_stream is None:
+        new_stream = _empty_stream
+    streams = {}
+    decode_failures = []
+
+    def fetch(run):
+        return timer.timed_iter('fetch', shards.fetch(s3_client, SESSION_BUCKET, run, cache, stats))
+
+    for chunk, category in decode_rollup_chunks(fetch, objects, rollups.categories, bot_id_filter,
+                                                STREAM_CHUNK_SESSIONS, decode_failures):
+        for bot_id, bot_chunk in chunk.groupby('bot_id', sort=False):
+            if bot_id not in streams:
+                streams[bot_id] = new_stream()
+            with timer.timed('aggregate'):
+                streams[bot_id].aggregate(bot_chunk, category)
+            with timer.timed('export'):
+                streams[bot_id].export(bot_chunk)
+    print(f'{sum(stream.sessions for stream in streams.values())} sessions extracted')
+
+    _report_decode_failures(decode_failures)
+    return streams
+
+
+def _map_reduce_sessions(timer, s3_client, shards, rollups, objects, bot_id_filter, cache, stats, new_stream=None):
+    # Parallel pipeline: ranges of objects are fetched, decoded and aggregated on a process pool
+    # and merged here. Ranges too small to split are streamed in process instead.
+    from report_mapreduce import map_reduce_sessions
+    from report_stream import STREAM_CHUNK_SESSIONS
+
+    if new_stream is None:
+        new_stream = _empty_stream
+    decode_failures = []
+    streams = map_reduce_sessions(timer, s3_client, SESSION_BUCKET, shards, rollups, objects, bot_id_filter,
+                                  STREAM_CHUNK_SESSIONS, stats, decode_failures, new_stream)
+    if streams is None:
+        return _stream_sessions(timer, s3_client, shards, rollups, objects, bot_id_filter, cache, stats,
+                                new_stream)
+    print(f'{sum(stream.sessions for stream in streams.values())} sessions extracted')
+
+    _report_decode_failures(decode_failures)
+    return streams
+
+
+def _empty_stream(spool_bytes=ARTIFACT_SPOOL_BYTES):
+    from report_stream import BotReportStream
+    return BotReportStream(artifact_buffer(spool_bytes), artifact_buffer(spool_bytes))
+
+
+def _batch_stream():
+    return _empty_stream(BATCH_ARTIFACT_SPOOL_BYTES)
+
+
+def _pipeline_mode():
+    from report_stream import pipeline_mode
+    return pipeline_mode()
+
+
+def _deliver_cached_report(timer, target, cached, sender_email, start_date, end_date_original, send_email,
+                           include_bot_id):
+    # Nothing in the range changed since the last run: e-mail the artifacts already uploaded
+    print(f"Reusing the report of {target.bot_id} built for data up to {cached['watermark']}")
+    with timer.stage('notify'):
+        notify_report(send_email, sender_email, target.recipients, target.bot_id, target.name_of_bot_user,
+                      start_date, end_date_original, cached['artifacts'], include_bot_id)
+
+    timings = timer.record()
+    print(json.dumps({'report_timings': timings}))
+    return {'sessions': cached['sessions'], 'artifacts': cached['artifacts'], 'timings': timings, 'cached': True}
+
+
+def _export_frame(timer, df, conversations):
+    # Figures and export artifacts of one bot's session frame, whose conversations are in
+    # the ConversationStore `conversations`.
+    # plotly and openpyxl are imported here rather than at module level, so cached reports
+    # and the job API never pay for them.
+    from create_visualisations import build_report_figures
+    from excel_export import DEFAULT_EXCEL_MODE, write_sessions_workbook
+    from report_stream import STREAM_CHUNK_SESSIONS, BotReportStream
+
+    with timer.stage('aggregate'):
+        figures = build_report_figures(df)
+
+    with timer.stage('export'):
+        csv_file = artifact_buffer()
+        excel_file = artifact_buffer()
+        if DEFAULT_EXCEL_MODE == 'legacy':
+            # The single sheet workbook is written by pandas from the whole frame
+            sessions = conversations.attach(df)
+            sessions.to_csv(csv_file, index=False)
+            write_sessions_workbook(sessions, excel_file, DEFAULT_EXCEL_MODE)
+        else:
+            # Conversations are loaded back one chunk at a time, never for the whole frame
+            exports = BotReportStream(csv_file, excel_file)
+            for chunk in conversations.iter_attached(df, STREAM_CHUNK_SESSIONS):
+                exports.export(chunk)
+            exports.save()
+
+    return figures, csv_file, excel_file
+
+
+def _export_stream(timer, bot_id, stream, rollups):
+    # Figures and export artifacts of a bot whose sessions were streamed into `stream`. The charts
+    # take the bot's stored days from `rollups`, and the closed days it rolled up are stored.
+    with timer.stage('export'):
+        stream.save()
+
+    with timer.stage('aggregate'):
+        figures = stream.figures(rollups.stored.get(bot_id))
+        rollups.save(bot_id, stream.closed_rollups)
+
+    return figures, stream.csv_file, stream.excel_file
+
+
+def _publish_report(timer, target, sessions, figures, csv_file, excel_file, sender_email, start_date,
+                    end_date_original, s3_client, send_email, include_bot_id, result_cache, cache_key, watermark):
+    # PDF, upload and e-mail of one bot's report
+    from report_pdf import render_report_images, assemble_report_pdf
+
+    with timer.stage('render'):
+        images, render_timings, pdf_mode = render_report_images(figures)
+
+    with timer.stage('assemble'):
+        pdf_file = artifact_buffer()
+        assemble_report_pdf(images, pdf_file, pdf_mode)
+
+    artifacts = {
+        'pdf': report_file_key(target.bot_id, start_date, end_date_original, 'pdf'),
+        'xlsx': report_file_key(target.bot_id, start_date, end_date_original, 'xlsx'),
+        'csv': report_file_key(target.bot_id, start_date, end_date_original, 'csv'),
+    }
+
+    # All artifacts go to S3 at once. The e-mail only links the PDF and XLSX, so it goes out as
+    # soon as those two are confirmed while the (much larger) CSV is still uploading.
+    uploads = ArtifactUploads(s3_client, REPORT_BUCKET, {extension: (artifacts[extension], artifact_file)
+                                                         for extension, artifact_file in [('xlsx', excel_file),
+                                                                                          ('pdf', pdf_file),
+                                                                                          ('csv', csv_file)]})
+    try:
+        with timer.stage('upload'):
+            uploads.wait(['pdf', 'xlsx'])
+
+        with timer.stage('notify'):
+            notify_report(send_email, sender_email, target.recipients, target.bot_id, target.name_of_bot_user,
+                          start_date, end_date_original, artifacts, include_bot_id)
+
+        with timer.stage('upload_remaining'):
+            upload_timings = uploads.wait()
+            result_cache.put(cache_key, s3_client, sessions, artifacts, watermark)
+    finally:
+        uploads.close()
+
+    timings = timer.record()
+    timings['render'] = render_timings
+    timings['uploads'] = list(upload_timings.values())
+    print(json.dumps({'report_timings': timings}))
+
+    return {
+        'sessions': sessions,
+        'artifacts': artifacts,
+        'timings': timings,
+        'cached': False,
+    }
+
+
+def run_report(start_date_dashboard, end_date_dashboard, bot_id_dashboard, name_of_bot_user, recipients,
+               sender_email, include_bot_id=False, s3_client=None, send_email=send_email_with_attachments,
+               job_id=None, on_stage=None, result_cache=None):
+    # Build, upload and e-mail the analytics report of one bot for [start, end] (YYYY-MM-DD strings).
+    # Every stage is timed, the timing record is printed as one JSON line and returned.
+    # on_stage is called with each stage name as it starts.
+    timer = StageTimer(job_id, on_stage)
+    if result_cache is None:
+        result_cache = ReportResultCache()
+    target = ReportTarget(bot_id_dashboard, name_of_bot_user, recipients)
+
+    start_date, end_date_original, end_date = _report_dates(start_date_dashboard, end_date_dashboard)
+
+    if s3_client is None:
+        s3_client = get_s3_client()
+    cache = get_session_cache()
+
+    # Retries and throttling of this job's S3 reads and its session cache hits, reported with its timings
+    fetch_stats = FetchStats()
+    timer.counters['s3_reads'] = fetch_stats
+    timer.counters['session_cache'] = CacheStats(cache)
+
+    with timer.stage('list'):
+        expired, interim, shards = _list_report_objects(s3_client, [bot_id_dashboard], start_date, end_date,
+                                                        cache, fetch_stats)
+        objects = expired[bot_id_dashboard] + interim
+
+    cache_key = report_cache_key(bot_id_dashboard, start_date, end_date_original, objects)
+    cached = result_cache.get(cache_key, s3_client, REPORT_BUCKET)
+    if cached is not None:
+        return _deliver_cached_report(timer, target, cached, sender_email, start_date, end_date_original,
+                                      send_email, include_bot_id)
+
+    mode = _pipeline_mode()
+    if mode in ('streaming', 'parallel'):
+        build_streams = _map_reduce_sessions if mode == 'parallel' else _stream_sessions
+        rollups = _report_rollups(s3_client, shards, expired)
+        with timer.stage('parse'):
+            streams = build_streams(timer, s3_client, shards, rollups, objects, bot_id_dashboard, cache,
+                                    fetch_stats)
+        stream = streams.get(bot_id_dashboard) or _empty_stream()
+        sessions = stream.sessions
+        figures, csv_file, excel_file = _export_stream(timer, bot_id_dashboard, stream, rollups)
+    else:
+        from session_store import ConversationStore
+        conversations = ConversationStore()
+        try:
+            with timer.stage('parse'):
+                df = _parse_sessions(timer, s3_client, shards, objects, bot_id_dashboard, cache, fetch_stats,
+                                     conversations)
+            sessions = len(df)
+            figures, csv_file, excel_file = _export_frame(timer, df, conversations)
+        finally:
+            conversations.close()
+
+    return _publish_report(timer, target, sessions, figures, csv_file, excel_file, sender_email, start_date,
+                           end_date_original, s3_client, send_email, include_bot_id, result_cache, cache_key,
+                           data_watermark(objects))
+
+
+def run_batch_report(start_date_dashboard, end_date_dashboard, targets, sender_email, include_bot_id=False,
+                     s3_client=None, send_email=send_email_with_attachments, job_id=None, on_stage=None,
+                     result_cache=None):
+    # Reports of several bots for the same range. targets are (bot_id, name_of_bot_user, recipients)
+    # tuples. The range is listed, downloaded and decoded once for all bots, then every bot gets
+    # its own aggregate/render/upload/notify pass. Returns the shared timings and a result per bot.
+    timer = StageTimer(job_id, on_stage)
+    if result_cache is None:
+        result_cache = ReportResultCache()
+    targets = [ReportTarget(*target) for target in targets]
+
+    start_date, end_date_original, end_date = _report_dates(start_date_dashboard, end_date_dashboard)
+
+    if s3_client is None:
+        s3_client = get_s3_client()
+    cache = get_session_cache()
+
+    # The reads are shared by all bots, so their retry, throttle and cache counts are reported once for the batch
+    fetch_stats = FetchStats()
+    timer.counters['s3_reads'] = fetch_stats
+    timer.counters['session_cache'] = CacheStats(cache)
+    with timer.stage('list'):
+        expired, interim, shards = _list_report_objects(s3_client, [target.bot_id for target in targets],
+                                                        start_date, end_date, cache, fetch_stats)
+
+    # Bots whose range did not change are served from the report cache and need no downloads
+    cache_keys = {}
+    cached = {}
+    for target in targets:
+        bot_objects = expired[target.bot_id] + interim
+        cache_keys[target.bot_id] = (report_cache_key(target.bot_id, start_date, end_date_original, bot_objects),
+                                     data_watermark(bot_objects))
+        cached_result = result_cache.get(cache_keys[target.bot_id][0], s3_client, REPORT_BUCKET)
+        if cached_result is not None:
+            cached[target.bot_id] = cached_result
+
+    # Per bot with sessions in range: its BotReportStream (streaming pipeline) or its frame
+    to_build = [target for target in targets if target.bot_id not in cached]
+    mode = _pipeline_mode() if to_build else None
+    streaming = mode in ('streaming', 'parallel')
+    sessions_by_bot = {}
+    rollups = None
+    conversations = None
+    try:
+        if to_build:
+            with timer.stage('parse'):
+                objects = [obj for target in to_build for obj in expired[target.bot_id]] + interim
+                bot_ids = [target.bot_id for target in to_build]
+                if streaming:
+                    build_streams = _map_reduce_sessions if mode == 'parallel' else _stream_sessions
+                    rollups = _report_rollups(s3_client, shards, {bot_id: expired[bot_id] for bot_id in bot_ids})
+                    sessions_by_bot = build_streams(timer, s3_client, shards, rollups, objects, bot_ids, cache,
+                                                    fetch_stats, _batch_stream)
+                else:
+                    from session_store import ConversationStore
+                    conversations = ConversationStore()
+                    df = _parse_sessions(timer, s3_client, shards, objects, bot_ids, cache, fetch_stats,
+                                         conversations)
+                    # Each bot's rows keep their index, which locates their conversations in the store
+                    sessions_by_bot = {bot_id: bot_df for bot_id, bot_df in df.groupby('bot_id', sort=False)}
+
+        reports = {}
+        for target in targets:
+            bot_on_stage = (lambda stage, bot_id=target.bot_id: on_stage(f'{bot_id}/{stage}')) if on_stage else None
+            bot_timer = StageTimer(f'{job_id}/{target.bot_id}' if job_id else target.bot_id, bot_on_stage)
+
+            # One bot failing must not keep the others from getting their report
+            try:
+                if target.bot_id in cached:
+                    reports[target.bot_id] = _deliver_cached_report(bot_timer, target, cached[target.bot_id],
+                                                                     sender_email, start_date, end_date_original,
+                                                                     send_email, include_bot_id)
+                    continue
+
+                if target.bot_id not in sessions_by_bot:
+                    print(f'No sessions of {target.bot_id} in range, no report sent')
+                    reports[target.bot_id] = {'sessions': 0, 'artifacts': None, 'timings': None, 'cached': False}
+                    continue
+
+                if streaming:
+                    stream = sessions_by_bot[target.bot_id]
+                    sessions = stream.sessions
+                    figures, csv_file, excel_file = _export_stream(bot_timer, target.bot_id, stream, rollups)
+                else:
+                    bot_df = sessions_by_bot[target.bot_id]
+                    sessions = len(bot_df)
+                    figures, csv_file, excel_file = _export_frame(bot_timer, bot_df, conversations)
+
+                cache_key, watermark = cache_keys[target.bot_id]
+                reports[target.bot_id] = _publish_report(bot_timer, target, sessions, figures, csv_file, excel_file,
+                                                         sender_email, start_date, end_date_original, s3_client,
+                                                         send_email, include_bot_id, result_cache, cache_key,
+                                                         watermark)
+            except Exception as e:
+                traceback.print_exc()
+                print(f'Report of {target.bot_id} failed: {type(e).__name__}: {e}')
+                reports[target.bot_id] = {'error': f'{type(e).__name__}: {e}'}
+    finally:
+        if conversations is not None:
+            conversations.close()
+
+    timings = timer.record()
+    print(json.dumps({'batch_timings': timings}))
+    return {'timings': timings, 'reports': reports}
@@ -0,0 +1,358 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+# Jobs survive restarts of the API in this SQLite file
+DEFAULT_JOB_DB = os.environ.get('REPORT_JOB_DB', '/tmp/report_jobs.sqlite3')
+# Report worker processes, i.e. how many reports are generated at the same time
+DEFAULT_REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+# How long an idle worker sleeps before looking for queued jobs again
+POLL_INTERVAL = float(os.environ.get('REPORT_JOB_POLL_INTERVAL', '1.0'))
+# How often the API process checks its report workers and restarts dead ones
+WORKER_CHECK_INTERVAL = float(os.environ.get('REPORT_WORKER_CHECK_INTERVAL', '5.0'))
+# A job interrupted by a restart or a dead worker this many times is marked failed instead of queued again
+MAX_ATTEMPTS = 3
+# Workers touch their running job's heartbeat_at this often. A running job without a heartbeat
+# for HEARTBEAT_TIMEOUT (worker frozen, or its pid reused after a restart) or running longer than
+# JOB_TIMEOUT (worker hung) is stale: it no longer holds back or absorbs requests and is requeued.
+HEARTBEAT_INTERVAL = float(os.environ.get('REPORT_JOB_HEARTBEAT_INTERVAL', '15.0'))
+HEARTBEAT_TIMEOUT = 4 * HEARTBEAT_INTERVAL
+JOB_TIMEOUT = float(os.environ.get('REPORT_JOB_TIMEOUT', '3600'))
+
+# Running jobs that still hold their lease, with the two cut-off times as parameters
+LIVE_RUNNING = "state = 'running' AND heartbeat_at >= ? AND started_at >= ?"
+
+JOB_STATES = ['queued', 'running', 'succeeded', 'failed']
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _lease_cutoffs():
+    now = time.time()
+    return now - HEARTBEAT_TIMEOUT, now - JOB_TIMEOUT
+
+
+def report_job_key(params):
+    # Requests for the same bot and range produce the same report
+    return '|'.join([params['bot_id_dashboard'], params['start_date_dashboard'], params['end_date_dashboard']])
+
+
+class JobStore:
+    # Persisted report job queue. Every method opens its own connection, so one store
+    # can be shared by the API and handed to worker processes by path.
+
+    def __init__(self, path=DEFAULT_JOB_DB):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    stage TEXT,
+                    params TEXT NOT NULL,
+                    coalesce_key TEXT NOT NULL DEFAULT '',
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_pid INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    heartbeat_at REAL,
+                    finished_at REAL
+                )""")
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(jobs)')]
+            if 'coalesce_key' not in columns:
+                connection.execute("ALTER TABLE jobs ADD COLUMN coalesce_key TEXT NOT NULL DEFAULT ''")
+            if 'heartbeat_at' not in columns:
+                connection.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at REAL')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_coalesce_key ON jobs (coalesce_key, state)')
+
+    @contextmanager
+    def _connect(self):
+        # isolation_level=None: transactions are opened explicitly where they are needed
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, params):
+        # Requests for a report that is already queued or running join that job instead of
+        # starting another one. Returns the job id.
+        coalesce_key = report_job_key(params)
+        recipients = params['email_recepient_internal_as_list']
+
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(f"SELECT job_id, state, params FROM jobs WHERE coalesce_key = ? "
+                                      f"AND (state = 'queued' OR ({LIVE_RUNNING})) ORDER BY created_at",
+                                      (coalesce_key, *_lease_cutoffs())).fetchall()
+
+            for job_id, state, job_params in rows:
+                job_params = json.loads(job_params)
+                job_recipients = job_params['email_recepient_internal_as_list']
+
+                if state == 'queued':
+                    # Not started yet, so the new recipients can still be added to the e-mail
+                    job_params['email_recepient_internal_as_list'] = job_recipients + [
+                        recipient for recipient in recipients if recipient not in job_recipients]
+                    connection.execute('UPDATE jobs SET params = ? WHERE job_id = ?',
+                                       (json.dumps(job_params), job_id))
+                    connection.execute('COMMIT')
+                    print(f'Coalesced report request onto queued job {job_id}')
+                    return job_id
+
+                if set(recipients) <= set(job_recipients):
+                    connection.execute('COMMIT')
+                    print(f'Coalesced report request onto running job {job_id}')
+                    return job_id
+
+            # Recipients the running job will not e-mail get a job of their own. claim() holds
+            # it back until the running one finishes, so it is served from the report cache.
+            job_id = uuid.uuid4().hex
+            connection.execute('INSERT INTO jobs (job_id, state, params, coalesce_key, created_at) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (job_id, 'queued', json.dumps(params), coalesce_key, time.time()))
+            connection.execute('COMMIT')
+        return job_id
+
+    def claim(self):
+        # Atomically move the oldest queued job to running, returns (job_id, params) or None.
+        # Jobs for a report that another worker is building wait until it is done.
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(f"SELECT job_id, params FROM jobs AS queued WHERE state = 'queued' "
+                                     f"AND NOT EXISTS (SELECT 1 FROM jobs AS running WHERE {LIVE_RUNNING} "
+                                     f"AND running.coalesce_key = queued.coalesce_key) "
+                                     f"ORDER BY created_at LIMIT 1", _lease_cutoffs()).fetchone()
+            if row is not None:
+                now = time.time()
+                connection.execute("UPDATE jobs SET state = 'running', stage = NULL, attempts = attempts + 1, "
+                                   "worker_pid = ?, started_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                                   (os.getpid(), now, now, row[0]))
+            connection.execute('COMMIT')
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    # The updates of a running job only apply while this process still holds it, so a worker whose
+    # job was requeued as stale cannot overwrite the run that replaced it
+
+    def set_stage(self, job_id, stage):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET stage = ?, heartbeat_at = ? WHERE job_id = ? AND state = 'running' "
+                               "AND worker_pid = ?", (stage, time.time(), job_id, os.getpid()))
+
+    def heartbeat(self, job_id):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND state = 'running' "
+                               "AND worker_pid = ?", (time.time(), job_id, os.getpid()))
+
+    def finish(self, job_id, result):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'succeeded', stage = NULL, result = ?, finished_at = ? "
+                               "WHERE job_id = ? AND state = 'running' AND worker_pid = ?",
+                               (json.dumps(result), time.time(), job_id, os.getpid()))
+
+    def fail(self, job_id, error):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'failed', error = ?, finished_at = ? "
+                               "WHERE job_id = ? AND state = 'running' AND worker_pid = ?",
+                               (error, time.time(), job_id, os.getpid()))
+
+    def requeue_interrupted(self):
+        # Running jobs whose worker process is gone (a restart of the API, or a worker that
+        # crashed or was killed) or whose lease expired (no heartbeat, or past JOB_TIMEOUT) go
+        # back to the queue, unless they already took down their workers MAX_ATTEMPTS times.
+        # Returns (worker_pid, started_at) of those jobs, so a pool can stop its own hung workers.
+        heartbeat_cutoff, started_cutoff = _lease_cutoffs()
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute("SELECT job_id, worker_pid, attempts, heartbeat_at, started_at FROM jobs "
+                                      "WHERE state = 'running'").fetchall()
+            interrupted = [(job_id, worker_pid, attempts, started_at)
+                           for job_id, worker_pid, attempts, heartbeat_at, started_at in rows
+                           if worker_pid is None or not _pid_alive(worker_pid)
+                           or (heartbeat_at or 0) < heartbeat_cutoff or (started_at or 0) < started_cutoff]
+            failed = [job_id for job_id, _, attempts, _ in interrupted if attempts >= MAX_ATTEMPTS]
+            requeued = [job_id for job_id, _, attempts, _ in interrupted if attempts < MAX_ATTEMPTS]
+            connection.executemany("UPDATE jobs SET state = 'failed', error = 'Interrupted too many times', "
+                                   "worker_pid = NULL, finished_at = ? WHERE job_id = ?",
+                                   [(time.time(), job_id) for job_id in failed])
+            connection.executemany("UPDATE jobs SET state = 'queued', worker_pid = NULL WHERE job_id = ?",
+                                   [(job_id,) for job_id in requeued])
+            connection.execute('COMMIT')
+        if failed:
+            print(f'Failed {len(failed)} report jobs interrupted {MAX_ATTEMPTS} times')
+        if requeued:
+            print(f'Requeued {len(requeued)} interrupted report jobs')
+        return [(worker_pid, started_at) for _, worker_pid, _, started_at in interrupted if worker_pid is not None]
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        result = json.loads(row['result']) if row['result'] else None
+        finished_or_now = row['finished_at'] or time.time()
+        return {
+            'job_id': row['job_id'],
+            'state': row['state'],
+            'stage': row['stage'],
+            'params': json.loads(row['params']),
+            'attempts': row['attempts'],
+            'error': row['error'],
+            'queued_s': round((row['started_at'] or finished_or_now) - row['created_at'], 3),
+            'running_s': round(finished_or_now - row['started_at'], 3) if row['started_at'] else None,
+            'sessions': result['sessions'] if result else None,
+            'artifacts': result['artifacts'] if result else None,
+            'timings': result['timings'] if result else None,
+        }
+
+    def counts(self):
+        with self._connect() as connection:
+            rows = connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        counts = {state: 0 for state in JOB_STATES}
+        counts.update(dict(rows))
+        return counts
+
+
+def _beat(store, job_id, done):
+    while not done.wait(HEARTBEAT_INTERVAL):
+        try:
+            store.heartbeat(job_id)
+        except sqlite3.Error as e:
+            # A busy database only delays the beat, the lease outlasts a few missed ones
+            print(f'Heartbeat of job {job_id} failed: {e}')
+
+
+def run_job(store, job_id, params):
+    # Imported here so the API process never loads the report pipeline
+    from report_engine import run_report
+
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_beat, args=(store, job_id, done), name='report-job-heartbeat', daemon=True)
+    heartbeat.start()
+    try:
+        result = run_report(params['start_date_dashboard'], params['end_date_dashboard'], params['bot_id_dashboard'],
+                            params['name_of_bot_user'], params['email_recepient_internal_as_list'],
+                            sender_email=params['sender_email'], include_bot_id=params.get('include_bot_id', False),
+                            job_id=job_id, on_stage=lambda stage: store.set_stage(job_id, stage))
+    except Exception as e:
+        traceback.print_exc()
+        store.fail(job_id, f'{type(e).__name__}: {e}')
+        return
+    finally:
+        done.set()
+        heartbeat.join()
+    store.finish(job_id, result)
+
+
+def _worker_main(db_path, stop_event):
+    store = JobStore(db_path)
+    print(f'Report worker {os.getpid()} started')
+    while not stop_event.is_set():
+        claimed = store.claim()
+        if claimed is None:
+            # Sleep rather than stop_event.wait(): a worker killed inside wait() would leave the
+            # event's condition waiting for it, and stop() would hang in set()
+            time.sleep(POLL_INTERVAL)
+            continue
+        job_id, params = claimed
+        print(f'Report worker {os.getpid()} running job {job_id}')
+        run_job(store, job_id, params)
+
+
+class ReportWorkerPool:
+    # Fixed number of worker processes draining the job queue. Workers finish their
+    # current job before stopping. A monitor thread replaces workers that die (e.g. killed
+    # for running out of memory) or hang past their job's lease, and requeues their job.
+
+    def __init__(self, store, workers=DEFAULT_REPORT_WORKERS):
+        self.store = store
+        self.workers = workers
+        # spawn, not fork: the API process runs an event loop and threads
+        self._context = multiprocessing.get_context('spawn')
+        self._stop_event = None
+        self._processes = []
+        # When each worker was started, a job it claimed cannot have started before that
+        self._started = []
+        self._monitor = None
+        self._monitor_stop = threading.Event()
+
+    def _start_worker(self, i):
+        # Not daemonic: workers start their own figure renderer processes
+        process = self._context.Process(target=_worker_main, args=(self.store.path, self._stop_event),
+                                        name=f'report-worker-{i}')
+        process.start()
+        return process
+
+    def start(self):
+        self.store.requeue_interrupted()
+        self._stop_event = self._context.Event()
+        self._processes = [self._start_worker(i) for i in range(self.workers)]
+        self._started = [time.time()] * self.workers
+        self._monitor_stop.clear()
+        self._monitor = threading.Thread(target=self._watch_workers, name='report-worker-monitor', daemon=True)
+        self._monitor.start()
+
+    def check_workers(self):
+        # Requeue (or fail) jobs of dead workers and expired leases, stop this pool's workers
+        # that hold such a job (hung), and restart the workers that are gone
+        if self._stop_event.is_set():
+            return 0
+        # is_alive() reaps exited workers, so their pids no longer look alive to requeue_interrupted
+        for process in self._processes:
+            process.is_alive()
+
+        for worker_pid, started_at in self.store.requeue_interrupted():
+            for i, process in enumerate(self._processes):
+                # A pid reused by a newer worker is not the one that holds the job
+                if process.pid == worker_pid and self._started[i] <= (started_at or 0) and process.is_alive():
+                    print(f'Report worker {process.pid} lost the lease of its job, stopping it')
+                    process.kill()
+                    process.join()
+
+        dead = [i for i, process in enumerate(self._processes) if not process.is_alive()]
+        for i in dead:
+            print(f'Report worker {self._processes[i].pid} exited with code {self._processes[i].exitcode}, restarting')
+            self._processes[i] = self._start_worker(i)
+            self._started[i] = time.time()
+        return len(dead)
+
+    def _watch_workers(self):
+        while not self._monitor_stop.wait(WORKER_CHECK_INTERVAL):
+            try:
+                self.check_workers()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self, timeout=None):
+        self._monitor_stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+            self._monitor = None
+        if self._stop_event is not None:
+            self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout)
+        self._processes = []
+
+    def alive(self):
+        return sum(process.is_alive() for process in self._processes)
@@ -0,0 +1,218 @@
+import atexit
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from botocore.client import BaseClient
+
+from excel_export import SheetFragmentWriter
+from s3_fetcher import DEFAULT_MAX_WORKERS, FetchStats, get_s3_client
+from session_cache import CacheStats, get_session_cache
+from session_rollups import CLOSED_DAY, STORED_DAY, daily_rollups_from_frame, decode_rollup_chunks
+from session_shards import ShardReader, ShardStore
+
+# Map worker processes of the parallel pipeline, each fetching, decoding and aggregating its own ranges
+DEFAULT_MAP_WORKERS = int(os.environ.get('REPORT_MAP_WORKERS', str(os.cpu_count() or 1)))
+
+# Fewest objects worth a map task of their own. Smaller reports are streamed in process.
+MIN_PARTITION_OBJECTS = int(os.environ.get('REPORT_MAP_MIN_PARTITION_OBJECTS', '2000'))
+
+# Ranges per worker, so a worker that finishes early picks up another one
+PARTITIONS_PER_WORKER = 4
+
+# Kept alive for the life of the process so later jobs skip the workers' start up and imports
+_map_pool = None
+_map_pool_workers = None
+
+
+def _get_map_pool(max_workers):
+    global _map_pool, _map_pool_workers
+    if _map_pool is None or _map_pool_workers != max_workers:
+        shutdown_map_pool()
+        try:
+            # spawn, not fork: the parent holds boto3 clients and fetch threads
+            _map_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _map_pool_workers = max_workers
+        except OSError as e:
+            # AWS Lambda has no /dev/shm, so multiprocessing pools cannot be created there
+            print(f'Map pool unavailable, streaming in process ({e})')
+            return None
+    return _map_pool
+
+
+def shutdown_map_pool():
+    global _map_pool, _map_pool_workers
+    if _map_pool is not None:
+        _map_pool.shutdown()
+        _map_pool = None
+        _map_pool_workers = None
+
+
+atexit.register(shutdown_map_pool)
+
+
+class PartitionExport:
+    # One bot's share of a map partition: daily rollups of its sessions (of closed days apart, like
+    # BotReportStream), plus its CSV rows and its rendered workbook rows in files. The reducer folds
+    # it into the bot's BotReportStream (merge_partition).
+
+    def __init__(self, csv_path, sheets_path):
+        self.rollups = {}
+        self.closed_rollups = {}
+        self.sessions = 0
+        self.csv_path = csv_path
+        self.sheets_path = sheets_path
+        self.sheet_rows = None
+        self.truncated = 0
+        self._csv_file = open(csv_path, 'wb')
+        self._sheets = SheetFragmentWriter(sheets_path)
+
+    def add(self, df, category=None):
+        if category != STORED_DAY:
+            daily_rollups_from_frame(df, self.closed_rollups if category == CLOSED_DAY else self.rollups)
+        df.to_csv(self._csv_file, index=False, header=self.sessions == 0)
+        self._sheets.append(df)
+        self.sessions += len(df)
+
+    def close(self):
+        self._csv_file.close()
+        self._sheets.close()
+        self.sheet_rows = self._sheets.rows
+        self.truncated = self._sheets.cell.truncated
+
+    def __getstate__(self):
+        # Sent back to the reducer without the open files
+        return {name: value for name, value in self.__dict__.items() if not name.startswith('_')}
+
+
+class MapReduceStats:
+    # Partitions and worker CPU time of one job's parallel pipeline. The job's StageTimer only
+    # measures its own process, the map work happens in the pool.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.partitions = 0
+        self.worker_cpu_s = 0.0
+
+    def as_dict(self):
+        return {'workers': self.workers, 'partitions': self.partitions, 'worker_cpu_s': round(self.worker_cpu_s, 3)}
+
+
+def partition_objects(objects, plan, partitions):
+    # Split objects into at most about `partitions` contiguous ranges of the same size. A range never
+    # ends inside a run of objects read from one shard ({key: shard}), so each shard is read once.
+    size = math.ceil(len(objects) / partitions)
+    ranges = []
+    current = []
+    current_shard = None
+    for obj in objects:
+        shard = plan.get(obj['Key'], {}).get('name')
+        if len(current) >= size and (shard is None or shard != current_shard):
+            ranges.append(current)
+            current = []
+        current.append(obj)
+        current_shard = shard
+    if current:
+        ranges.append(current)
+    return ranges
+
+
+def map_partition(index, objects, plan, categories, s3_client, bucket_name, shard_location, bot_id_filter,
+                  chunk_sessions, max_workers, spool_dir):
+    # Map task: fetch, decode and aggregate one range of objects, in a pool worker. Returns
+    # {bot_id: PartitionExport}, the decode failures, the read and cache counts and the CPU time it took.
+    cpu_started = time.process_time()
+    if s3_client is None:
+        s3_client = get_s3_client(max_workers)
+    stats = FetchStats()
+    cache = get_session_cache()
+    cache_stats = CacheStats(cache)
+    decode_failures = []
+    shards = ShardReader(ShardStore(shard_location, s3_client), None, [], plan)
+
+    def fetch(run):
+        return shards.fetch(s3_client, bucket_name, run, cache, stats, max_workers)
+
+    exports = {}
+    try:
+        for chunk, category in decode_rollup_chunks(fetch, objects, categories, bot_id_filter, chunk_sessions,
+                                                    decode_failures):
+            for bot_id, bot_chunk in chunk.groupby('bot_id', sort=False):
+                if bot_id not in exports:
+                    name = os.path.join(spool_dir, f'{index}-{len(exports)}')
+                    exports[bot_id] = PartitionExport(f'{name}.csv', f'{name}.xlsx')
+                exports[bot_id].add(bot_chunk, category)
+    finally:
+        for export in exports.values():
+            export.close()
+
+    return {'exports': exports, 'decode_failures': decode_failures, 's3_reads': stats.as_dict(),
+            'session_cache': cache_stats.as_dict(), 'cpu_s': time.process_time() - cpu_started}
+
+
+def map_reduce_sessions(timer, s3_client, bucket_name, shards, rollups, objects, bot_id_filter, chunk_sessions,
+                        stats, decode_failures, new_stream, max_workers=DEFAULT_MAP_WORKERS):
+    # {bot_id: BotReportStream} of the bots with sessions, like the streaming pipeline, but contiguous
+    # ranges of objects are fetched, decoded and aggregated on the map pool. Their partial rollups
+    # and exports are merged here in listing order, so the artifacts come out the same.
+    # Returns None when the range is too small to split or no pool can be started.
+    partitions = min(max_workers * PARTITIONS_PER_WORKER, len(objects) // MIN_PARTITION_OBJECTS)
+    if max_workers < 2 or partitions < 2:
+        return None
+    pool = _get_map_pool(max_workers)
+    if pool is None:
+        return None
+
+    plan = shards.plan
+    categories = rollups.categories
+    ranges = partition_objects(objects, plan, partitions)
+    map_stats = MapReduceStats(max_workers)
+    map_stats.partitions = len(ranges)
+    timer.counters['map_reduce'] = map_stats
+    # The workers share the fetch concurrency one process would have had
+    fetch_workers = max(1, DEFAULT_MAX_WORKERS // max_workers)
+    # boto3 clients cannot be pickled, workers create their own
+    worker_client = None if isinstance(s3_client, BaseClient) else s3_client
+
+    spool_dir = tempfile.mkdtemp(prefix='report-map-')
+    futures = []
+    streams = {}
+    try:
+        for index, partition in enumerate(ranges):
+            partition_plan = {obj['Key']: plan[obj['Key']] for obj in partition if obj['Key'] in plan}
+            partition_categories = {obj['Key']: categories[obj['Key']] for obj in partition
+                                    if obj['Key'] in categories}
+            futures.append(pool.submit(map_partition, index, partition, partition_plan, partition_categories,
+                                       worker_client, bucket_name, shards.store.location, bot_id_filter,
+                                       chunk_sessions, fetch_workers, spool_dir))
+
+        # Reduce each partition as soon as it and every one before it are done
+        for result in timer.timed_iter('map', (future.result() for future in futures)):
+            with timer.timed('reduce'):
+                for bot_id, export in result['exports'].items():
+                    if bot_id not in streams:
+                        streams[bot_id] = new_stream()
+                    streams[bot_id].merge_partition(export)
+                    os.remove(export.csv_path)
+                    os.remove(export.sheets_path)
+                decode_failures.extend(result['decode_failures'])
+                stats.merge(result['s3_reads'])
+                if 'session_cache' in timer.counters:
+                    timer.counters['session_cache'].merge(result['session_cache'])
+                map_stats.worker_cpu_s += result['cpu_s']
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory), the next job starts a new pool
+        shutdown_map_pool()
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    print(f'{len(ranges)} partitions mapped on {max_workers} workers')
+    return streams
@@ -0,0 +1,68 @@
+from typing import NamedTuple
+
+import pandas as pd
+
+
+class ReportMetrics(NamedTuple):
+    # Everything the report charts plot. Built from the session frame by
+    # compute_report_metrics or from daily rollups by session_rollups.summarise_rollups.
+
+    # Per day (created_at_date, UTC)
+    turns_per_day: pd.Series
+    sessions_per_day: pd.Series
+    average_turns_per_day: pd.Series
+    # Sessions per day (rows) and number of turns (columns)
+    turns_by_day: pd.DataFrame
+
+    # Number of turns -> sessions, hour of the day (Central) -> sessions, component name -> occurrences
+    turn_counts: pd.Series
+    sessions_by_hour: pd.Series
+    component_counts: pd.Series
+
+    total_sessions: int
+    total_turns: int
+    average_session_length: float
+    total_failures: int
+    report_count: int
+    trigger_count: int
+    average_max_consecutive_fails: float
+    confidence_threshold: float
+    auto_add_threshold_lower: float
+    auto_add_threshold_upper: float
+
+
+def compute_report_metrics(df):
+    # One grouped pass per dimension (day, day x turns, hour, component) plus column
+    # reductions, instead of every chart grouping the frame again
+    daily = df.groupby('created_at_date').agg(turns=('turns', 'sum'), average_turns=('turns', 'mean'),
+                                              sessions=('session_id', 'nunique'))
+    sessions_by_day_and_turns = df.groupby(['created_at_date', 'turns']).size()
+
+    component_names = [component.get('component_name') for row in df['component_info'] for component in row]
+
+    # Sessions appear once per row unless the same session was listed twice
+    total_sessions = df['session_id'].nunique()
+    if total_sessions == len(df):
+        average_session_length = df['turns'].mean()
+    else:
+        average_session_length = df.groupby('session_id')['turns'].sum().mean()
+
+    return ReportMetrics(
+        turns_per_day=daily['turns'],
+        sessions_per_day=daily['sessions'],
+        average_turns_per_day=daily['average_turns'],
+        turns_by_day=sessions_by_day_and_turns.unstack().fillna(0),
+        turn_counts=sessions_by_day_and_turns.groupby(level='turns').sum(),
+        sessions_by_hour=df.groupby('created_at_hour_central')['session_id'].count(),
+        component_counts=pd.Series(component_names, dtype=object).value_counts(),
+        total_sessions=total_sessions,
+        total_turns=df['turns'].sum(),
+        average_session_length=average_session_length,
+        total_failures=df['fail_counter'].sum(),
+        report_count=(df['report_indices'].str.len() > 0).sum(),
+        trigger_count=(df['email_triggers'].str.len() > 0).sum(),
+        average_max_consecutive_fails=df['max_consecutive_fails'].mean(),
+        confidence_threshold=df['confidence_threshold'].mean(),
+        auto_add_threshold_lower=df['auto_add_threshold_lower'].mean(),
+        auto_add_threshold_upper=df['auto_add_threshold_upper'].mean(),
+    )
@@ -0,0 +1,105 @@
+import io
+import os
+
+from reportlab.graphics import renderPDF
+from reportlab.lib.pagesizes import landscape, A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from figure_renderer import render_figures
+
+# svglib turns the renderer's SVG into reportlab drawings, without it only raster pages are possible
+try:
+    from svglib.svglib import svg2rlg
+except ImportError:
+    svg2rlg = None
+
+# 'vector' embeds figures as PDF vector graphics, 'raster' as 3400x1200 PNGs
+DEFAULT_PDF_MODE = os.environ.get('REPORT_PDF_MODE', 'vector')
+
+FIGURE_WIDTH = 1700
+FIGURE_HEIGHT = 600
+RASTER_SCALE = 2
+
+
+def _page_placement(width, height):
+    # Scale to fit a landscape A4 page and centre it
+    scale = min(A4[1] / width, A4[0] / height)
+    new_width = width * scale
+    new_height = height * scale
+    return scale, (A4[1] - new_width) / 2, (A4[0] - new_height) / 2, new_width, new_height
+
+
+def _vector_drawing(svg):
+    # The figure as a reportlab drawing, or None when svglib cannot convert it (e.g. the gauge of
+    # a report without sessions). Drawn once on a scratch canvas so a drawing that fails halfway
+    # never leaves a broken page in the report.
+    try:
+        drawing = svg2rlg(io.BytesIO(svg))
+        if drawing is None:
+            return None
+        renderPDF.draw(drawing, canvas.Canvas(io.BytesIO()), 0, 0)
+    except Exception as e:
+        print(f'Figure could not be converted to vector graphics ({type(e).__name__}: {e})')
+        return None
+    return drawing
+
+
+def _draw_vector_page(c, drawing):
+    scale, x, y, _, _ = _page_placement(drawing.width, drawing.height)
+    drawing.scale(scale, scale)
+    renderPDF.draw(drawing, c, x, y)
+
+
+def _draw_raster_page(c, png):
+    img = ImageReader(io.BytesIO(png))
+    img_width, img_height = img.getSize()
+    _, x, y, new_width, new_height = _page_placement(img_width, img_height)
+    c.drawImage(img, x, y, new_width, new_height)
+
+
+def render_report_images(figures, mode=DEFAULT_PDF_MODE):
+    # Render the figures for the given PDF mode.
+    # Returns the images, the per-figure render timings and the mode actually used.
+    if mode == 'vector' and svg2rlg is None:
+        print('svglib is not installed, falling back to raster PDF pages')
+        mode = 'raster'
+
+    if mode == 'vector':
+        svgs, render_timings = render_figures(figures, image_format='svg', width=FIGURE_WIDTH,
+                                              height=FIGURE_HEIGHT, scale=1)
+        images = [_vector_drawing(svg) for svg in svgs]
+
+        # Figures svglib cannot handle become raster pages
+        failed = [i for i, image in enumerate(images) if image is None]
+        if failed:
+            pngs, raster_timings = render_figures([figures[i] for i in failed], image_format='png',
+                                                  width=FIGURE_WIDTH, height=FIGURE_HEIGHT, scale=RASTER_SCALE)
+            for i, png, timing in zip(failed, pngs, raster_timings):
+                images[i] = png
+                render_timings.append(dict(timing, figure=i + 1, fallback='raster'))
+    else:
+        images, render_timings = render_figures(figures, image_format='png', width=FIGURE_WIDTH,
+                                                height=FIGURE_HEIGHT, scale=RASTER_SCALE)
+
+    return images, render_timings, mode
+
+
+def assemble_report_pdf(images, pdf_file, mode=DEFAULT_PDF_MODE):
+    # Write one landscape A4 page per rendered figure to pdf_file (a path or file object).
+    # Vector reports hold drawings, plus PNGs for the figures that fell back to raster.
+    c = canvas.Canvas(pdf_file, pagesize=landscape(A4))
+    for image in images:
+        if mode == 'vector' and not isinstance(image, bytes):
+            _draw_vector_page(c, image)
+        else:
+            _draw_raster_page(c, image)
+        c.showPage()  # Add a new page after each figure
+    c.save()
+
+
+def write_report_pdf(figures, pdf_file, mode=DEFAULT_PDF_MODE):
+    # Render the figures and assemble the PDF, returns the per-figure render timings
+    images, render_timings, mode = render_report_images(figures, mode)
+    assemble_report_pdf(images, pdf_file, mode)
+    return render_timings
@@ -0,0 +1,82 @@
+import os
+import shutil
+
+from create_visualisations import build_figures_from_metrics
+from excel_export import DEFAULT_EXCEL_MODE, SessionWorkbookWriter
+from extract_data import session_frame
+from session_rollups import CLOSED_DAY, STORED_DAY, DailyRollup, daily_rollups_from_frame, summarise_rollups
+
+# 'streaming' folds sessions into aggregates and artifacts chunk by chunk as they are decoded,
+# 'parallel' does the same on a process pool, one contiguous range of objects per task
+# (report_mapreduce.py), and 'frame' decodes the whole range into one frame first. The legacy
+# single sheet workbook is written by pandas from the whole frame, so it always uses the frame pipeline.
+DEFAULT_PIPELINE_MODE = os.environ.get('REPORT_PIPELINE_MODE', 'streaming')
+
+# Full sessions (conversations included) held in memory at a time by the streaming pipeline
+STREAM_CHUNK_SESSIONS = int(os.environ.get('REPORT_STREAM_CHUNK_SESSIONS', '1000'))
+
+
+def pipeline_mode(mode=DEFAULT_PIPELINE_MODE, excel_mode=DEFAULT_EXCEL_MODE):
+    return 'frame' if excel_mode == 'legacy' else mode
+
+
+class BotReportStream:
+    # Everything one bot's report needs, built incrementally from chunks of its sessions:
+    # daily rollups for the charts, and the CSV and XLSX exports written row by row.
+    # Only the rollups stay in memory, the exports go to the given artifact files.
+    # Closed days are rolled up apart (closed_rollups) so they can be stored, see ReportRollups.
+
+    def __init__(self, csv_file, excel_file):
+        self.csv_file = csv_file
+        self.excel_file = excel_file
+        self.rollups = {}
+        self.closed_rollups = {}
+        self.workbook = SessionWorkbookWriter()
+        self.sessions = 0
+
+    def aggregate(self, df, category=None):
+        # Sessions of stored days are charted from their stored rollups, they are only exported
+        if category == STORED_DAY:
+            return
+        daily_rollups_from_frame(df, self.closed_rollups if category == CLOSED_DAY else self.rollups)
+
+    def export(self, df):
+        # Same columns as the frame pipeline's CSV, the header only comes with the first chunk
+        df.to_csv(self.csv_file, index=False, header=self.sessions == 0)
+        self.workbook.append(df)
+        self.sessions += len(df)
+
+    def merge_partition(self, partition):
+        # Add one bot's share of a map partition (report_mapreduce.PartitionExport). Partitions
+        # have to be merged in listing order so the exports keep the streaming pipeline's order.
+        # A session present in two partitions is one session but two rows, as in a single stream.
+        for rollups, partition_rollups in [(self.rollups, partition.rollups),
+                                           (self.closed_rollups, partition.closed_rollups)]:
+            for day, rollup in partition_rollups.items():
+                if day in rollups:
+                    rollups[day].merge(rollup)
+                else:
+                    rollups[day] = rollup
+
+        with open(partition.csv_path, 'rb') as csv_part:
+            # Every part starts with the header, only the first one is kept
+            if self.sessions:
+                csv_part.readline()
+            shutil.copyfileobj(csv_part, self.csv_file)
+        self.workbook.append_fragment(partition.sheets_path, partition.sheet_rows, partition.truncated)
+        self.sessions += partition.sessions
+
+    def save(self):
+        # The CSV is complete after the last chunk, the workbook still has to be zipped up.
+        # A bot without sessions still gets the headers, like an empty frame's export.
+        if self.sessions == 0:
+            self.export(session_frame([]))
+        self.workbook.save(self.excel_file)
+
+    def figures(self, stored_rollups=None):
+        # Charts of the aggregated days together with the bot's stored ones ({day: DailyRollup})
+        daily_rollups = {}
+        for rollups in [self.rollups, self.closed_rollups, stored_rollups or {}]:
+            for day, rollup in rollups.items():
+                daily_rollups.setdefault(day, DailyRollup()).merge(rollup)
+        return build_figures_from_metrics(summarise_rollups(daily_rollups))
@@ -0,0 +1,250 @@
+import boto3
+import os
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError, IncompleteReadError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Most objects downloaded in parallel. The fetch starts below this and adapts to throttling.
+DEFAULT_MAX_WORKERS = int(os.environ.get('S3_FETCH_CONCURRENCY', '32'))
+DEFAULT_INITIAL_CONCURRENCY = int(os.environ.get('S3_FETCH_INITIAL_CONCURRENCY', '8'))
+MIN_CONCURRENCY = 1
+
+# Attempts per object and the bounds of the jittered exponential backoff between them (seconds)
+FETCH_MAX_ATTEMPTS = int(os.environ.get('S3_FETCH_MAX_ATTEMPTS', '8'))
+RETRY_BASE_DELAY = float(os.environ.get('S3_RETRY_BASE_DELAY', '0.1'))
+RETRY_MAX_DELAY = float(os.environ.get('S3_RETRY_MAX_DELAY', '5'))
+
+# S3 asking us to slow down, as opposed to a failure worth retrying at the same pace
+THROTTLE_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                        'RequestThrottled', 'ServiceUnavailable', '503'}
+TRANSIENT_ERROR_CODES = {'InternalError', 'RequestTimeout', '500'}
+
+# One client per pool size, shared by every thread (boto3 clients are thread safe)
+_s3_clients = {}
+
+
+def get_s3_client(max_pool_connections=DEFAULT_MAX_WORKERS):
+    if max_pool_connections not in _s3_clients:
+        # Retrieve AWS access keys from environment variables
+        access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+
+        # Size the connection pool so every fetch thread gets its own connection
+        config = Config(max_pool_connections=max_pool_connections)
+        _s3_clients[max_pool_connections] = boto3.client('s3', aws_access_key_id=access_key,
+                                                         aws_secret_access_key=secret_key, config=config)
+
+    return _s3_clients[max_pool_connections]
+
+
+def list_all_objects(s3_client, bucket_name, prefix):
+    # list_objects_v2 returns at most 1000 keys per call, so walk every page
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    objects = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+
+    # Same shape as a single list_objects_v2 response
+    return {'Contents': objects}
+
+
+def objects_in_range(response, start_date, end_date):
+    # Compare the last modified date with the threshold before downloading anything
+    return [obj for obj in response['Contents']
+            if start_date <= obj['LastModified'].replace(tzinfo=None) <= end_date]
+
+
+class FetchStats:
+    # Request, retry and throttle counts of one job's S3 reads, shared by its fetch threads.
+    # retries include the ones botocore made before an error or response reached us.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttles = 0
+        self.min_concurrency = None
+        self.final_concurrency = None
+
+    def add(self, requests=0, retries=0, throttles=0, concurrency=None):
+        with self._lock:
+            self.requests += requests
+            self.retries += retries
+            self.throttles += throttles
+            if concurrency is not None:
+                self.min_concurrency = min(concurrency, self.min_concurrency or concurrency)
+                self.final_concurrency = concurrency
+
+    def merge(self, counts):
+        # Counts of another process's reads (its as_dict), e.g. a map worker of the parallel pipeline
+        with self._lock:
+            self.requests += counts['requests']
+            self.retries += counts['retries']
+            self.throttles += counts['throttles']
+            concurrency = counts['min_concurrency']
+            if concurrency is not None:
+                self.min_concurrency = min(concurrency, self.min_concurrency or concurrency)
+                self.final_concurrency = counts['final_concurrency']
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'min_concurrency': self.min_concurrency,
+            'final_concurrency': self.final_concurrency,
+        }
+
+
+class AdaptiveLimiter:
+    # Caps the GETs in flight with AIMD: +1 per window of successful requests, halved on throttling.
+    # Throttles of requests sent before the last cut do not cut again, so one burst of SlowDowns
+    # halves the limit once rather than once per request. release returns the updated limit.
+
+    def __init__(self, initial, maximum, minimum=MIN_CONCURRENCY):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.generation = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self.generation
+
+    def release(self, generation, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                if generation == self.generation:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.generation += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            return int(self.limit)
+
+
+# One limiter per bucket, so a warm process keeps the concurrency it learned
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(bucket_name, max_workers=DEFAULT_MAX_WORKERS):
+    with _limiters_lock:
+        if bucket_name not in _limiters:
+            _limiters[bucket_name] = AdaptiveLimiter(DEFAULT_INITIAL_CONCURRENCY, max_workers)
+        limiter = _limiters[bucket_name]
+        limiter.maximum = max_workers
+        limiter.limit = min(limiter.limit, max_workers)
+        return limiter
+
+
+def _botocore_retries(response):
+    return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+
+def _classify_error(e):
+    # 'throttle', 'transient' or None (not worth retrying, e.g. NoSuchKey or AccessDenied)
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLE_ERROR_CODES or status in (429, 503):
+            return 'throttle'
+        if code in TRANSIENT_ERROR_CODES or status in (500, 502, 504):
+            return 'transient'
+        return None
+    # Dropped connections, timeouts and bodies cut short while streaming
+    if isinstance(e, (ConnectionError, HTTPClientError, IncompleteReadError)):
+        return 'transient'
+    return None
+
+
+def retry_delay(attempt):
+    # Full jitter: anywhere between 0 and the exponential bound, so throttled threads spread out
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _get_object_body(s3_client, bucket_name, key, limiter, stats):
+    attempt = 0
+    while True:
+        generation = limiter.acquire()
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=key)
+            body = response['Body'].read()
+        except Exception as e:
+            kind = _classify_error(e)
+            concurrency = limiter.release(generation, throttled=kind == 'throttle')
+            botocore_retries = _botocore_retries(e.response) if isinstance(e, ClientError) else 0
+            stats.add(requests=1, retries=botocore_retries, throttles=1 if kind == 'throttle' else 0,
+                      concurrency=concurrency)
+            attempt += 1
+            if kind is None or attempt >= FETCH_MAX_ATTEMPTS:
+                raise
+            stats.add(retries=1)
+            time.sleep(retry_delay(attempt))
+            continue
+
+        # botocore retrying on its own means we are pushing too hard as well
+        botocore_retries = _botocore_retries(response)
+        concurrency = limiter.release(generation, throttled=botocore_retries > 0)
+        stats.add(requests=1, retries=botocore_retries, concurrency=concurrency)
+        return response, body
+
+
+def get_object_body(s3_client, bucket_name, key, stats=None, max_workers=DEFAULT_MAX_WORKERS):
+    # A single GET with the same throttling, retries and accounting as fetch_objects
+    _, body = _get_object_body(s3_client, bucket_name, key, get_limiter(bucket_name, max_workers),
+                               stats if stats is not None else FetchStats())
+    return body
+
+
+def _download_object(s3_client, bucket_name, obj, cache=None, limiter=None, stats=None):
+    etag = obj.get('ETag')
+
+    # Read through the local cache when the listing gave us an ETag to key it by
+    if cache is not None and etag:
+        body = cache.get(obj['Key'], etag)
+        if body is not None:
+            return body
+
+    response, body = _get_object_body(s3_client, bucket_name, obj['Key'], limiter, stats)
+
+    if cache is not None:
+        cache.put(obj['Key'], response['ETag'], body)
+
+    return body
+
+
+def fetch_objects(s3_client, bucket_name, objects, max_workers=DEFAULT_MAX_WORKERS, cache=None, stats=None):
+    # Download objects on a bounded thread pool and yield (obj, body) in listing order.
+    # At most 2 * max_workers downloads are pending at any time so memory stays bounded,
+    # and the bucket's AdaptiveLimiter decides how many of them are actually in flight.
+    # Throttled and transient failures are retried with backoff and counted in stats.
+    limiter = get_limiter(bucket_name, max_workers)
+    if stats is None:
+        stats = FetchStats()
+    window = max_workers * 2
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for obj in objects:
+            pending.append((obj, executor.submit(_download_object, s3_client, bucket_name, obj, cache, limiter,
+                                                 stats)))
+
+            if len(pending) >= window:
+                done_obj, future = pending.popleft()
+                yield done_obj, future.result()
+
+        while pending:
+            done_obj, future = pending.popleft()
+            yield done_obj, future.result()
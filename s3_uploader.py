@@ -0,0 +1,50 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+# Artifacts above this size are uploaded in parts of this size
+DEFAULT_UPLOAD_CHUNK_BYTES = int(os.environ.get('S3_UPLOAD_CHUNK_BYTES', str(8 * 1024 * 1024)))
+# Parts of one artifact uploaded in parallel
+DEFAULT_UPLOAD_CONCURRENCY = int(os.environ.get('S3_UPLOAD_CONCURRENCY', '8'))
+
+
+def upload_transfer_config(chunk_bytes=DEFAULT_UPLOAD_CHUNK_BYTES, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+    return TransferConfig(multipart_threshold=chunk_bytes, multipart_chunksize=chunk_bytes,
+                          max_concurrency=concurrency, use_threads=True)
+
+
+def _upload_artifact(s3_client, bucket_name, key, artifact_file, config):
+    # Upload one artifact buffer and close it, returns its throughput record
+    with artifact_file:
+        size = artifact_file.seek(0, os.SEEK_END)
+        artifact_file.seek(0)
+        started = time.perf_counter()
+        s3_client.upload_fileobj(artifact_file, bucket_name, key, Config=config)
+        seconds = time.perf_counter() - started
+
+    return {'key': key, 'bytes': size, 'seconds': round(seconds, 3),
+            'mb_per_s': round(size / (1024 * 1024) / seconds, 2) if seconds else None}
+
+
+class ArtifactUploads:
+    # Uploads every artifact at the same time, each with multipart chunking, so the
+    # caller can wait for just the ones it needs next (e.g. the files linked in the e-mail)
+
+    def __init__(self, s3_client, bucket_name, artifact_files, config=None):
+        # artifact_files: {name: (key, file object)}, the files are closed once uploaded
+        if config is None:
+            config = upload_transfer_config()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(artifact_files), 1))
+        self._futures = {name: self._executor.submit(_upload_artifact, s3_client, bucket_name, key, artifact_file,
+                                                     config)
+                         for name, (key, artifact_file) in artifact_files.items()}
+
+    def wait(self, names=None):
+        # Block until the named uploads (all by default) are confirmed, re-raising the first failure
+        names = list(self._futures) if names is None else names
+        return {name: self._futures[name].result() for name in names}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -6,11 +6,22 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# Clients are created once per process and reused by warm Lambda containers and workers
+_clients = {}
+
+
+def _get_client(service_name, region=None):
+    if (service_name, region) not in _clients:
+        access_key = os.getenv('AWS_ACCESS_KEY_ID')
+        secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+        _clients[(service_name, region)] = boto3.client(service_name, region_name=region, aws_access_key_id=access_key,
+                                                        aws_secret_access_key=secret_key)
+    return _clients[(service_name, region)]
+
+
 def send_email_with_attachments(sender_email, recipients, subject, body_text, bucket_name, file_names, region):
-    access_key = os.getenv('AWS_ACCESS_KEY_ID')
-    secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-    s3_client = boto3.client('s3', aws_access_key_id=access_key, aws_secret_access_key=secret_key)
-    ses_client = boto3.client('ses', region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+    s3_client = _get_client('s3')
+    ses_client = _get_client('ses', region)
 
     urls = []
     for file_name in file_names:
@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import os
+import threading
+
+# Local cache of session JSON, sized for Lambda's /tmp by default
+DEFAULT_CACHE_DIR = os.environ.get('SESSION_CACHE_DIR', '/tmp/session_cache')
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get('SESSION_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Share of max_bytes a full cache is evicted down to
+EVICT_TO = 0.9
+
+
+class SessionCache:
+    # Content addressed by (S3 key, ETag): a rewritten object gets a new ETag and simply
+    # misses, so entries never need invalidating. Report workers, map workers and the session
+    # index share the directory, so the directory is the index: a file's mtime is its last use,
+    # and whichever process finds the cache past max_bytes evicts the least recently used files
+    # of all of them, holding a lock on the directory.
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Bytes in the directory at the last scan, plus what this process wrote since
+        self._size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._evict()
+
+    def _name(self, key, etag):
+        return hashlib.sha256(f'{key}\0{etag}'.encode('utf-8')).hexdigest()
+
+    def get(self, key, etag):
+        path = os.path.join(self.directory, self._name(key, etag))
+
+        try:
+            with open(path, 'rb') as cached_file:
+                body = cached_file.read()
+        except FileNotFoundError:
+            # Never cached, or evicted by another thread or process
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        try:
+            # Keep the mtime current, it is the file's place in the LRU order
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return body
+
+    def put(self, key, etag, body):
+        path = os.path.join(self.directory, self._name(key, etag))
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as cached_file:
+            cached_file.write(body)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += len(body)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescan the directory and remove the least recently used files until it is back under
+        # EVICT_TO of max_bytes, so a full cache is not rescanned on every put
+        with open(os.path.join(self.directory, '.lock'), 'wb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+            self._size = sum(size for _, _, size in entries)
+            if self._size <= self.max_bytes:
+                return
+            for _, name, size in sorted(entries):
+                if self._size <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self._size}
+
+
+class CacheStats:
+    # Hits and misses of one job's reads through the session cache: what this process's cache
+    # counted since the job started, plus the counts of other processes (map workers) merged in
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._started = cache.stats()
+        self._merged = {'hits': 0, 'misses': 0}
+
+    def merge(self, counts):
+        # Another process's CacheStats.as_dict()
+        self._merged['hits'] += counts['hits']
+        self._merged['misses'] += counts['misses']
+
+    def as_dict(self):
+        stats = self.cache.stats()
+        return {
+            'hits': stats['hits'] - self._started['hits'] + self._merged['hits'],
+            'misses': stats['misses'] - self._started['misses'] + self._merged['misses'],
+        }
+
+
+_session_cache = None
+
+
+def get_session_cache():
+    # One cache per process so warm containers keep their hit counters and LRU state
+    global _session_cache
+    if _session_cache is None:
+        _session_cache = SessionCache()
+    return _session_cache
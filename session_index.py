@@ -0,0 +1,208 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+
+from s3_fetcher import DEFAULT_MAX_WORKERS, list_all_objects, fetch_objects
+from session_cache import get_session_cache
+from session_schema import SessionDecodeError, peek_session_header, session_decoder
+
+# Where the index lives between runs, either a local path or s3://bucket/key
+DEFAULT_INDEX_LOCATION = os.environ.get('SESSION_INDEX_LOCATION', '/tmp/session_index.json')
+
+
+def _split_s3_location(location):
+    bucket_name, _, key = location[len('s3://'):].partition('/')
+    return bucket_name, key
+
+
+class SessionIndex:
+    # Maps bot_id -> created_at day (UTC, YYYY-MM-DD) -> {S3 key: [LastModified, ETag]}.
+    # Only objects modified after the watermark are downloaded on refresh, so every
+    # session object is read once to index it instead of once per report.
+    # Every object modified from covered_from (None: from the start) to the watermark is indexed.
+    # A new index only covers what the first report asked for, and grows back as older ranges
+    # are requested, so a cold start never downloads the prefix's whole history.
+
+    def __init__(self, location=DEFAULT_INDEX_LOCATION):
+        self.location = location
+        self.watermark = None
+        self.watermark_keys = set()
+        self.covered_from = None
+        self.bots = {}
+        # The index as loaded, so an unchanged index is not written back
+        self._stored = None
+
+    def load(self, s3_client=None):
+        try:
+            if self.location.startswith('s3://'):
+                bucket_name, key = _split_s3_location(self.location)
+                body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+            else:
+                with open(self.location, 'rb') as index_file:
+                    body = index_file.read()
+        except FileNotFoundError:
+            print(f"No session index at {self.location}, building from scratch")
+            return self
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            print(f"No session index at {self.location}, building from scratch")
+            return self
+
+        stored = json.loads(body)
+        self.watermark = datetime.fromisoformat(stored['watermark']) if stored['watermark'] else None
+        self.watermark_keys = set(stored['watermark_keys'])
+        # Indexes written before coverage was recorded were built from the whole prefix
+        self.covered_from = datetime.fromisoformat(stored['covered_from']) if stored.get('covered_from') else None
+        self.bots = stored['bots']
+        self._stored = self._dumps()
+        return self
+
+    def _dumps(self):
+        return json.dumps({
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'watermark_keys': sorted(self.watermark_keys),
+            'covered_from': self.covered_from.isoformat() if self.covered_from else None,
+            'bots': self.bots,
+        }).encode('utf-8')
+
+    def save(self, s3_client=None):
+        body = self._dumps()
+        if body == self._stored:
+            return
+
+        if self.location.startswith('s3://'):
+            bucket_name, key = _split_s3_location(self.location)
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        else:
+            # Write then rename so a crash never leaves a half written index
+            tmp_path = f'{self.location}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as index_file:
+                index_file.write(body)
+            os.replace(tmp_path, self.location)
+        self._stored = body
+
+    def _is_new(self, obj):
+        last_modified = obj['LastModified'].replace(tzinfo=None)
+        if self.watermark is None or last_modified > self.watermark:
+            return True
+        return last_modified == self.watermark and obj['Key'] not in self.watermark_keys
+
+    def _to_index(self, obj, since):
+        # Objects refresh has to read to cover everything modified from `since` (None: from the start)
+        last_modified = obj['LastModified'].replace(tzinfo=None)
+        if since is not None and last_modified < since and (self.watermark is None or last_modified <= self.watermark):
+            return False
+        if self._is_new(obj):
+            # Newer than the watermark, always indexed so the covered range stays contiguous
+            return True
+        return self.covered_from is not None and last_modified < self.covered_from
+
+    def _add(self, bot_id, created_at, obj):
+        created_at_day = datetime.utcfromtimestamp(created_at // 1000).strftime('%Y-%m-%d')
+        last_modified = obj['LastModified'].replace(tzinfo=None)
+        days = self.bots.setdefault(bot_id, {})
+        days.setdefault(created_at_day, {})[obj['Key']] = [last_modified.isoformat(), obj.get('ETag')]
+
+    def _prune(self, listed_keys, rewritten_keys):
+        # Drop keys that no longer exist in the bucket (e.g. removed by a lifecycle rule)
+        # and keys that were rewritten, which get indexed again from their new contents
+        for days in self.bots.values():
+            for day in list(days):
+                days[day] = {key: entry for key, entry in days[day].items()
+                             if key in listed_keys and key not in rewritten_keys}
+                if not days[day]:
+                    del days[day]
+
+    def refresh(self, s3_client, bucket_name, prefix, max_workers=DEFAULT_MAX_WORKERS, cache=None, stats=None,
+                since=None):
+        # Index what is new, and what is older than the covered range back to `since` (a naive UTC
+        # datetime, None for the whole prefix)
+        listed = list_all_objects(s3_client, bucket_name, prefix)['Contents']
+        new_objects = [obj for obj in listed if self._to_index(obj, since)]
+        print(f'session index: {len(new_objects)} new of {len(listed)} listed objects')
+
+        self._prune({obj['Key'] for obj in listed}, {obj['Key'] for obj in new_objects})
+
+        for obj, body in fetch_objects(s3_client, bucket_name, new_objects, max_workers, cache, stats):
+            header = peek_session_header(body)
+            if header is not None:
+                bot_id, created_at = header
+            else:
+                try:
+                    document = session_decoder.parse(body, obj['Key'])
+                except SessionDecodeError as e:
+                    print(f"Malformed session data in file: {obj['Key']} ({e.reason})")
+                    continue
+                bot_id = document.get('bot_id')
+                created_at = document.get('created_at')
+
+            if bot_id is not None and created_at is not None:
+                self._add(bot_id, created_at, obj)
+
+        if self.watermark is None:
+            if new_objects:
+                self.covered_from = since
+        elif self.covered_from is not None and (since is None or since < self.covered_from):
+            self.covered_from = since
+
+        # Advance the watermark to the newest object seen
+        if new_objects:
+            newest = max(obj['LastModified'].replace(tzinfo=None) for obj in new_objects)
+            if self.watermark is None or newest > self.watermark:
+                self.watermark = newest
+                self.watermark_keys = set()
+            self.watermark_keys.update(obj['Key'] for obj in new_objects
+                                       if obj['LastModified'].replace(tzinfo=None) == self.watermark)
+
+        return self
+
+    def objects_for(self, bot_id, start_date, end_date):
+        # A session is created before it is last modified, so days after end_date can be skipped
+        # (one day of slack for clock skew between the bot and S3)
+        last_day = (end_date + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        objects = []
+        for day, keys in sorted(self.bots.get(bot_id, {}).items()):
+            if day > last_day:
+                break
+            for key, (last_modified, etag) in keys.items():
+                last_modified = datetime.fromisoformat(last_modified)
+                if start_date <= last_modified <= end_date:
+                    objects.append({'Key': key, 'LastModified': last_modified, 'ETag': etag})
+
+        # Same shape as a list_objects_v2 response, ready for objects_in_range
+        return {'Contents': objects}
+
+
+@contextmanager
+def _index_lock(location):
+    # Workers sharing a local index refresh it one at a time, the next one loads the saved
+    # index and only has the objects added since to read. An index on S3 is not locked.
+    if location.startswith('s3://'):
+        yield
+        return
+    with open(f'{location}.lock', 'wb') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_session_index(s3_client, bucket_name, prefix, location=DEFAULT_INDEX_LOCATION,
+                       max_workers=DEFAULT_MAX_WORKERS, cache=None, stats=None, since=None):
+    # Load the stored index, index anything new under the prefix and persist it again if it changed.
+    # A report passes the start of its range as since, so only objects modified from then on have
+    # to be indexed; compaction leaves it None and indexes the whole prefix.
+    # New objects go through the session cache, so the report that follows reads them locally.
+    if cache is None:
+        cache = get_session_cache()
+    with _index_lock(location):
+        session_index = SessionIndex(location).load(s3_client)
+        session_index.refresh(s3_client, bucket_name, prefix, max_workers, cache, stats, since)
+        session_index.save(s3_client)
+    return session_index
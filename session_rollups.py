@@ -0,0 +1,255 @@
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from extract_data import decode_session_chunks
+from report_metrics import ReportMetrics
+from s3_fetcher import DEFAULT_MAX_WORKERS, get_object_body
+from session_shards import SHARD_CLOSED_AFTER_DAYS, day_digest
+
+# Where per-bot daily rollups are kept, either a local directory or s3://bucket/prefix
+DEFAULT_ROLLUP_LOCATION = os.environ.get('SESSION_ROLLUP_LOCATION', '/tmp/session_rollups')
+
+# Categories of a report's objects (ReportRollups.categories): sessions of a 'stored' day are charted
+# from its stored rollup, those of a 'closed' day are aggregated apart and stored after the report
+STORED_DAY = 'stored'
+CLOSED_DAY = 'closed'
+
+# Rollups are summed as plain numbers, means are derived as sum / rows when reading
+SUMMED_COLUMNS = ['turns', 'fail_counter', 'confidence_threshold', 'auto_add_threshold_lower',
+                  'auto_add_threshold_upper', 'max_consecutive_fails']
+
+
+class DailyRollup:
+    # Mergeable partial aggregates of one bot's sessions created on one day (UTC).
+    # Holds everything the report charts need, so chunks (streaming), partitions (parallel)
+    # and the stored days of a range (RollupStore) are aggregated separately and merged.
+
+    def __init__(self):
+        self.session_ids = set()
+        self.rows = 0
+        self.sums = dict.fromkeys(SUMMED_COLUMNS, 0)
+        self.reports = 0
+        self.email_triggers = 0
+        self.turns_histogram = Counter()
+        self.hour_histogram = Counter()
+        self.component_counts = Counter()
+
+    def add_session(self, session):
+        # session is a row of a session frame (extract_data.session_frame, itertuples).
+        # Like the frame pipeline (compute_report_metrics) every row is counted, also a session
+        # listed twice (e.g. interim and expired); session counts are of distinct session_ids.
+        self.session_ids.add(session.session_id)
+        self.rows += 1
+        for column in SUMMED_COLUMNS:
+            self.sums[column] += getattr(session, column)
+        self.reports += 1 if session.report_indices else 0
+        self.email_triggers += 1 if session.email_triggers else 0
+        self.turns_histogram[session.turns] += 1
+        self.hour_histogram[session.created_at_hour_central] += 1
+        self.component_counts.update(component['component_name'] for component in session.component_info
+                                     if component.get('component_name') is not None)
+
+    def merge(self, other):
+        self.session_ids |= other.session_ids
+        self.rows += other.rows
+        for column in SUMMED_COLUMNS:
+            self.sums[column] += other.sums[column]
+        self.reports += other.reports
+        self.email_triggers += other.email_triggers
+        self.turns_histogram.update(other.turns_histogram)
+        self.hour_histogram.update(other.hour_histogram)
+        self.component_counts.update(other.component_counts)
+        return self
+
+    def to_dict(self):
+        return {
+            'session_ids': sorted(self.session_ids),
+            'rows': self.rows,
+            'sums': self.sums,
+            'reports': self.reports,
+            'email_triggers': self.email_triggers,
+            'turns_histogram': self.turns_histogram,
+            'hour_histogram': self.hour_histogram,
+            'component_counts': self.component_counts,
+        }
+
+    @classmethod
+    def from_dict(cls, stored):
+        rollup = cls()
+        rollup.session_ids = set(stored['session_ids'])
+        rollup.rows = stored['rows']
+        rollup.sums.update(stored['sums'])
+        rollup.reports = stored['reports']
+        rollup.email_triggers = stored['email_triggers']
+        # JSON object keys are strings, the histograms are keyed by ints
+        rollup.turns_histogram = Counter({int(turns): count for turns, count in stored['turns_histogram'].items()})
+        rollup.hour_histogram = Counter({int(hour): count for hour, count in stored['hour_histogram'].items()})
+        rollup.component_counts = Counter(stored['component_counts'])
+        return rollup
+
+
+def daily_rollups_from_frame(df, rollups=None):
+    # Fold the sessions of a frame into per-day rollups (optionally on top of existing ones)
+    rollups = {} if rollups is None else rollups
+    for session in df.itertuples(index=False):
+        rollups.setdefault(session.created_at_date, DailyRollup()).add_session(session)
+    return rollups
+
+
+def summarise_rollups(daily_rollups):
+    # ReportMetrics of the whole range, from {day: DailyRollup}
+    days = sorted(daily_rollups)
+    total = DailyRollup()
+    for day in days:
+        total.merge(daily_rollups[day])
+
+    rows = total.rows or float('nan')
+    return ReportMetrics(
+        turns_per_day=pd.Series([daily_rollups[day].sums['turns'] for day in days], index=days),
+        sessions_per_day=pd.Series([len(daily_rollups[day].session_ids) for day in days], index=days),
+        average_turns_per_day=pd.Series([daily_rollups[day].sums['turns'] / daily_rollups[day].rows for day in days],
+                                        index=days, dtype=float),
+        turns_by_day=pd.DataFrame({day: daily_rollups[day].turns_histogram for day in days}).T.fillna(0),
+        turn_counts=pd.Series(total.turns_histogram, dtype=int),
+        sessions_by_hour=pd.Series(total.hour_histogram, dtype=int),
+        component_counts=pd.Series(total.component_counts, dtype=int),
+        total_sessions=len(total.session_ids),
+        total_turns=total.sums['turns'],
+        average_session_length=total.sums['turns'] / (len(total.session_ids) or float('nan')),
+        total_failures=total.sums['fail_counter'],
+        report_count=total.reports,
+        trigger_count=total.email_triggers,
+        average_max_consecutive_fails=total.sums['max_consecutive_fails'] / rows,
+        confidence_threshold=total.sums['confidence_threshold'] / rows,
+        auto_add_threshold_lower=total.sums['auto_add_threshold_lower'] / rows,
+        auto_add_threshold_upper=total.sums['auto_add_threshold_upper'] / rows,
+    )
+
+
+class RollupStore:
+    # One JSON document per bot and closed day ({location}/{bot_id}/{day}.json):
+    # {"digest", "rollup", "updated_at"}, the digest (session_shards.day_digest) being that of the
+    # indexed objects the rollup was aggregated from
+
+    def __init__(self, location=DEFAULT_ROLLUP_LOCATION, s3_client=None):
+        self.location = location
+        self.s3_client = s3_client
+
+    def _path(self, name):
+        return f'{self.location.rstrip("/")}/{name}'
+
+    def _read(self, name):
+        path = self._path(name)
+        try:
+            if path.startswith('s3://'):
+                bucket_name, _, key = path[len('s3://'):].partition('/')
+                return get_object_body(self.s3_client, bucket_name, key)
+            with open(path, 'rb') as stored_file:
+                return stored_file.read()
+        except FileNotFoundError:
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return None
+
+    def _write(self, name, body):
+        path = self._path(name)
+        if path.startswith('s3://'):
+            bucket_name, _, key = path[len('s3://'):].partition('/')
+            self.s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+            return
+
+        # Write then rename so readers never see a half written rollup
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.{os.getpid()}.tmp', 'wb') as stored_file:
+            stored_file.write(body)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def load_day(self, bot_id, day, digest):
+        # The stored rollup of the day, unless its objects changed since it was aggregated
+        stored = self._read(f'{bot_id}/{day}.json')
+        if stored is None:
+            return None
+        stored = json.loads(stored)
+        return DailyRollup.from_dict(stored['rollup']) if stored['digest'] == digest else None
+
+    def save_day(self, bot_id, day, digest, rollup):
+        self._write(f'{bot_id}/{day}.json', json.dumps({
+            'digest': digest, 'rollup': rollup.to_dict(),
+            'updated_at': datetime.utcnow().isoformat(timespec='seconds'),
+        }).encode('utf-8'))
+
+
+class ReportRollups:
+    # Which of a report's sessions are charted from stored rollups. A closed day (as for the shards,
+    # SHARD_CLOSED_AFTER_DAYS) whose indexed objects are all in the report is 'stored' when the store
+    # has its rollup for the same objects, and 'closed' otherwise: its sessions are then aggregated
+    # apart from the rest and their rollup stored once the report has them (save). Interim objects
+    # and every other day are aggregated as before. The exports always get every session.
+
+    def __init__(self, store, session_index, expired, closed_before=None):
+        if closed_before is None:
+            closed_before = (datetime.utcnow() - timedelta(days=SHARD_CLOSED_AFTER_DAYS)).strftime('%Y-%m-%d')
+        self.store = store
+        self.session_index = session_index
+        self.expired = expired
+        self.closed_before = closed_before
+        # {bot_id: {day: DailyRollup}} of the stored days and {bot_id: {day: digest}} of the closed ones
+        self.stored = {}
+        self.pending = {}
+        self._categories = None
+
+    @property
+    def categories(self):
+        # {key: STORED_DAY or CLOSED_DAY} of the expired objects of those days. The store is only
+        # read once a report actually decodes sessions.
+        if self._categories is None:
+            candidates = []
+            for bot_id, objects in self.expired.items():
+                keys = {obj['Key'] for obj in objects}
+                for day, entries in sorted(self.session_index.bots.get(bot_id, {}).items()):
+                    if day >= self.closed_before:
+                        break
+                    if keys and entries.keys() <= keys:
+                        candidates.append((bot_id, day, day_digest(entries)))
+
+            # A long range has one stored rollup per day, they are read concurrently
+            with ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS) as executor:
+                loaded = list(executor.map(lambda candidate: self.store.load_day(*candidate), candidates))
+
+            self._categories = {}
+            for (bot_id, day, digest), rollup in zip(candidates, loaded):
+                if rollup is not None:
+                    self.stored.setdefault(bot_id, {})[day] = rollup
+                    category = STORED_DAY
+                else:
+                    self.pending.setdefault(bot_id, {})[day] = digest
+                    category = CLOSED_DAY
+                for key in self.session_index.bots[bot_id][day]:
+                    self._categories[key] = category
+            print(f'{sum(len(days) for days in self.stored.values())} days charted from stored rollups, '
+                  f'{sum(len(days) for days in self.pending.values())} to store')
+        return self._categories
+
+    def save(self, bot_id, closed_rollups):
+        # Store the rollups of the bot's closed days, aggregated from their 'closed' sessions alone
+        for day, digest in self.pending.get(bot_id, {}).items():
+            if day in closed_rollups:
+                self.store.save_day(bot_id, day, digest, closed_rollups[day])
+
+
+def decode_rollup_chunks(fetch, objects, categories, bot_id_filter, chunk_sessions, decode_failures):
+    # decode_session_chunks of objects downloaded by fetch(objects), as (chunk, category) pairs with
+    # the category (ReportRollups.categories, None for the rest) of the objects in the chunk. Runs of
+    # objects of one category are fetched and decoded on their own, so no chunk mixes categories.
+    for category, run in groupby(objects, key=lambda obj: categories.get(obj['Key'])):
+        for chunk in decode_session_chunks(fetch(list(run)), bot_id_filter, chunk_sessions, decode_failures):
+            yield chunk, category
@@ -0,0 +1,187 @@
+import json
+import re
+from typing import Any, Callable, NamedTuple, Optional
+
+# orjson parses session documents several times faster than the standard library
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+NUMBER = (int, float)
+
+
+def conversation_from_turns(turns):
+    # Flatten history turns into one {'speaker', 'utterance'} entry per utterance
+    conversation = []
+    for turn in turns or []:
+        if 'speaker' in turn and 'utterance' in turn:
+            speaker = turn['speaker']
+            for utterance in turn['utterance']:
+                conversation.append({
+                    'speaker': speaker,
+                    'utterance': utterance
+                })
+
+    return conversation if conversation else [{}]
+
+
+def components_from_query_results(query_results):
+    # Keep the id and name of every component returned by the semantic search
+    component_info = []
+    for query_result in query_results or []:
+        component_id = query_result.get('_source', {}).get('component_id')
+        component_name = query_result.get('_source', {}).get('component_name')
+
+        component_info.append({
+            'component_id': component_id if component_id else None,
+            'component_name': component_name if component_name else ''
+        })
+
+    return component_info if component_info else [{}]
+
+
+# "bot_id" / "created_at" members anywhere in a raw session document. bot_id values are captured
+# as raw JSON, escapes included (e.g. "b\u00f2t" or "bot\/1"), so they only equal the decoded id
+# when they contain no backslash.
+BOT_ID_PATTERN = re.compile(rb'"bot_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+CREATED_AT_PATTERN = re.compile(rb'"created_at"\s*:\s*(\d+)')
+
+
+def peek_session_header(raw):
+    # Read bot_id and created_at straight from the raw bytes without decoding the document.
+    # Returns None when either is missing or appears with more than one value, in which
+    # case the caller has to fall back to json.loads.
+    bot_ids = set(BOT_ID_PATTERN.findall(raw))
+    created_ats = set(CREATED_AT_PATTERN.findall(raw))
+    if len(bot_ids) != 1 or len(created_ats) != 1:
+        return None
+    if b'\\' in next(iter(bot_ids)):
+        # Escaped, only json.loads knows the real value
+        return None
+
+    return bot_ids.pop().decode('utf-8'), int(created_ats.pop())
+
+
+def bot_id_set(bot_id_filter):
+    # Filters are a single bot id or a collection of them (batch reports)
+    return {bot_id_filter} if isinstance(bot_id_filter, str) else set(bot_id_filter)
+
+
+def session_may_match(raw, bot_id_filter):
+    # Conservative pre-filter: False only when no "bot_id" in the document can equal the
+    # filter, so a matching session is never dropped. The full decode re-checks the rest.
+    # A bot_id written with escapes may decode to anything, so it is left to the full decode.
+    bot_ids_bytes = {bot_id.encode('utf-8') for bot_id in bot_id_set(bot_id_filter)}
+    if len(bot_ids_bytes) == 1 and b'\\' not in raw and next(iter(bot_ids_bytes)) not in raw:
+        return False
+
+    for raw_bot_id in BOT_ID_PATTERN.findall(raw):
+        if raw_bot_id in bot_ids_bytes or b'\\' in raw_bot_id:
+            return True
+    return False
+
+
+class SchemaField(NamedTuple):
+    name: str
+    # Keys to follow from the document root
+    path: tuple
+    # Accepted types of the value at path, None to accept anything
+    types: Optional[tuple] = None
+    # Missing required fields make the whole session malformed, optional ones become None
+    required: bool = True
+    # Applied to the value at path (None when an optional field is missing)
+    transform: Optional[Callable[[Any], Any]] = None
+
+
+# Every field the report pipeline reads from a session document, in column order
+SESSION_SCHEMA = [
+    SchemaField('session_id', ('session_id',), required=False),
+    SchemaField('account_id', ('account_id',), required=False),
+    SchemaField('referrer', ('referrer',), required=False),
+    SchemaField('bot_name', ('bot_name',), required=False),
+    SchemaField('bot_id', ('bot_id',), required=False),
+    SchemaField('turns', ('history', 'turns'), (list,), transform=len),
+    SchemaField('created_at', ('created_at',), NUMBER),
+    SchemaField('is_billable', ('is_billable',), required=False),
+    SchemaField('is_test', ('is_test',), required=False),
+    SchemaField('confidence_threshold', ('config', 'semantic_search', 'confidence_threshold'), NUMBER),
+    SchemaField('auto_add_threshold_lower', ('config', 'online_learning', 'utterance_auto_add_threshold_lower'), NUMBER),
+    SchemaField('auto_add_threshold_upper', ('config', 'online_learning', 'utterance_auto_add_threshold_upper'), NUMBER),
+    SchemaField('fail_counter', ('state', 'fail_counter'), NUMBER),
+    SchemaField('fail_turn_indices', ('state', 'fail_turn_indices'), (list,)),
+    SchemaField('report_indices', ('state', 'report_indices'), (list,)),
+    SchemaField('email_triggers', ('state', 'email_triggers'), (list,)),
+    SchemaField('max_consecutive_fails', ('config', 'fail_mechanism', 'max_consecutive_fails'), NUMBER),
+    SchemaField('user_conversation', ('history', 'turns'), (list,), transform=conversation_from_turns),
+    SchemaField('component_info', ('state', 'component_state', 'query_results'), (list,), required=False,
+                transform=components_from_query_results),
+]
+
+
+class SessionDecodeError(ValueError):
+    def __init__(self, key, field, reason):
+        super().__init__(f'{key}: {field or "document"}: {reason}')
+        self.key = key
+        self.field = field
+        self.reason = reason
+
+    def as_dict(self):
+        return {'key': self.key, 'field': self.field, 'reason': self.reason}
+
+
+def _compile_field(field):
+    dotted_path = '.'.join(field.path)
+
+    def read(document, key):
+        value = document
+        for part in field.path:
+            if not isinstance(value, dict) or part not in value:
+                if field.required:
+                    raise SessionDecodeError(key, field.name, f'missing {dotted_path}')
+                value = None
+                break
+            value = value[part]
+
+        if value is not None and field.types and not isinstance(value, field.types):
+            raise SessionDecodeError(key, field.name,
+                                     f'expected {"/".join(t.__name__ for t in field.types)} at {dotted_path}, '
+                                     f'got {type(value).__name__}')
+
+        if field.transform is not None:
+            return field.transform(value)
+        return value
+
+    return read
+
+
+class SessionDecoder:
+    # Compiles a schema once into per-field readers and turns raw session JSON into
+    # compact records holding only the schema's fields, so the parsed tree can be
+    # released as soon as a session is decoded.
+
+    def __init__(self, schema=SESSION_SCHEMA, record_name='SessionRecord'):
+        self.schema = schema
+        self.record_type = NamedTuple(record_name, [(field.name, Any) for field in schema])
+        self._readers = [_compile_field(field) for field in schema]
+
+    def parse(self, raw, key=None):
+        try:
+            document = _loads(raw)
+        except ValueError as e:
+            raise SessionDecodeError(key, None, f'invalid JSON: {e}')
+
+        if not isinstance(document, dict):
+            raise SessionDecodeError(key, None, f'expected an object, got {type(document).__name__}')
+        return document
+
+    def decode_document(self, document, key=None):
+        return self.record_type(*[read(document, key) for read in self._readers])
+
+    def decode(self, raw, key=None):
+        return self.decode_document(self.parse(raw, key), key)
+
+
+session_decoder = SessionDecoder()
+SessionRecord = session_decoder.record_type
@@ -0,0 +1,250 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from botocore.exceptions import ClientError
+
+from s3_fetcher import DEFAULT_MAX_WORKERS, FetchStats, fetch_objects, get_object_body
+from session_schema import SessionDecodeError, session_decoder
+
+# orjson writes and reads shard lines several times faster than the standard library
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+# Where compacted shards and their manifest live, either a local directory or s3://bucket/prefix
+DEFAULT_SHARD_LOCATION = os.environ.get('SESSION_SHARD_LOCATION', '/tmp/session_shards')
+
+# Sessions keep being written for a while after the day they were created on, so only days at
+# least this old (UTC) are compacted
+SHARD_CLOSED_AFTER_DAYS = int(os.environ.get('SESSION_SHARD_CLOSED_AFTER_DAYS', '2'))
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def shard_name(bot_id, day):
+    return f'{bot_id}/{day}.jsonl.gz'
+
+
+def day_digest(entries):
+    # Fingerprint of one bot's indexed objects for one day ({key: [LastModified, ETag]}), so a
+    # day whose objects changed since it was compacted is compacted again
+    return hashlib.sha256(_dumps(sorted([key] + entry for key, entry in entries.items()))).hexdigest()
+
+
+def encode_shard(sessions):
+    # gzipped JSON lines of {"key", "last_modified", "etag", "session"} from (obj, document) pairs.
+    # Returns the shard and the number of sessions in it, only the compressed bytes are held.
+    buffer = io.BytesIO()
+    count = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as shard_file:
+        for obj, document in sessions:
+            shard_file.write(_dumps({'key': obj['Key'],
+                                     'last_modified': obj['LastModified'].replace(tzinfo=None).isoformat(),
+                                     'etag': obj.get('ETag'), 'session': document}) + b'\n')
+            count += 1
+    return buffer.getvalue(), count
+
+
+def iter_shard(data):
+    # (obj, body) pairs of a shard, shaped like listed objects and their downloaded bodies.
+    # Lines are decompressed as they are read, never the whole shard at once.
+    for line in gzip.GzipFile(fileobj=io.BytesIO(data)):
+        if not line.strip():
+            continue
+        entry = _loads(line)
+        obj = {'Key': entry['key'], 'LastModified': datetime.fromisoformat(entry['last_modified']),
+               'ETag': entry['etag']}
+        yield obj, _dumps(entry['session'])
+
+
+class ShardStore:
+    # Shards ({location}/{bot_id}/{day}.jsonl.gz) of closed days plus a manifest describing them:
+    # {"shards": {bot_id: {day: {"name", "sha256", "sessions", "bytes", "digest", "compacted_at"}}}}
+
+    def __init__(self, location=DEFAULT_SHARD_LOCATION, s3_client=None):
+        self.location = location
+        self.s3_client = s3_client
+
+    def _path(self, name):
+        return f'{self.location.rstrip("/")}/{name}'
+
+    def _read(self, name, stats=None):
+        path = self._path(name)
+        try:
+            if path.startswith('s3://'):
+                bucket_name, _, key = path[len('s3://'):].partition('/')
+                return get_object_body(self.s3_client, bucket_name, key, stats)
+            with open(path, 'rb') as stored_file:
+                return stored_file.read()
+        except FileNotFoundError:
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return None
+
+    def _write(self, name, body):
+        path = self._path(name)
+        if path.startswith('s3://'):
+            bucket_name, _, key = path[len('s3://'):].partition('/')
+            self.s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+            return
+
+        # Write then rename so readers never see a half written shard or manifest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'wb') as stored_file:
+            stored_file.write(body)
+        os.replace(f'{path}.tmp', path)
+
+    def load_manifest(self):
+        stored = self._read(MANIFEST_NAME)
+        return json.loads(stored) if stored else {'shards': {}}
+
+    def save_manifest(self, manifest):
+        self._write(MANIFEST_NAME, json.dumps(manifest).encode('utf-8'))
+
+    def read_shard(self, shard, cache=None, stats=None):
+        # Shards are immutable under their sha256, so the session cache can keep them
+        if cache is not None:
+            data = cache.get(self._path(shard['name']), shard['sha256'])
+            if data is not None:
+                return data
+
+        data = self._read(shard['name'], stats)
+        if data is None:
+            return None
+        if cache is not None:
+            cache.put(self._path(shard['name']), shard['sha256'], data)
+        return data
+
+    def write_shard(self, name, data):
+        self._write(name, data)
+
+
+def _parsed_sessions(bodies):
+    for obj, body in bodies:
+        try:
+            yield obj, session_decoder.parse(body, obj['Key'])
+        except SessionDecodeError as e:
+            # Left out of the shard, reports fetch (and report) it individually
+            print(f"Malformed session data in file: {obj['Key']} ({e.reason})")
+
+
+def compact_sessions(store, session_index, s3_client, bucket_name, bot_ids=None, closed_before=None,
+                     max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    # Roll the indexed expired/ sessions of every closed day into one shard per bot and day.
+    # Days already compacted from the same objects are skipped. The source objects are left alone.
+    if closed_before is None:
+        closed_before = (datetime.utcnow() - timedelta(days=SHARD_CLOSED_AFTER_DAYS)).strftime('%Y-%m-%d')
+    manifest = store.load_manifest()
+    stats = FetchStats()
+
+    compacted = []
+    for bot_id in bot_ids or sorted(session_index.bots):
+        bot_shards = manifest['shards'].setdefault(bot_id, {})
+        for day, entries in sorted(session_index.bots.get(bot_id, {}).items()):
+            if day >= closed_before:
+                break
+            digest = day_digest(entries)
+            if bot_shards.get(day, {}).get('digest') == digest:
+                continue
+
+            # Same order as the index lists them, so reports read shards in listing order
+            objects = [{'Key': key, 'LastModified': datetime.fromisoformat(last_modified), 'ETag': etag}
+                       for key, (last_modified, etag) in entries.items()]
+            data, sessions = encode_shard(_parsed_sessions(
+                fetch_objects(s3_client, bucket_name, objects, max_workers, cache, stats)))
+            name = shard_name(bot_id, day)
+            store.write_shard(name, data)
+            bot_shards[day] = {'name': name, 'sha256': hashlib.sha256(data).hexdigest(), 'sessions': sessions,
+                               'bytes': len(data), 'digest': digest,
+                               'compacted_at': datetime.utcnow().isoformat(timespec='seconds')}
+            compacted.append((bot_id, day))
+
+            # Saved after every shard so an interrupted run keeps what it finished
+            store.save_manifest(manifest)
+
+    print(f'compaction: {len(compacted)} shards written, {stats.requests} objects read')
+    return compacted
+
+
+class ShardReader:
+    # Reads report sessions out of shards for compacted days and from the single objects otherwise.
+    # Driven by the session index: the objects a report asked for decide which shards are read.
+    # A plan computed elsewhere ({key: shard}, see plan) can be given instead of the index.
+
+    def __init__(self, store, session_index, bot_ids, plan=None):
+        self.store = store
+        self.session_index = session_index
+        self.bot_ids = bot_ids
+        self._plan = plan
+
+    @property
+    def plan(self):
+        # {key: shard} for every indexed object of the bots whose day has a shard. The manifest
+        # is only read once a report actually downloads sessions.
+        if self._plan is None:
+            manifest = self.store.load_manifest()
+            self._plan = {}
+            for bot_id in self.bot_ids:
+                indexed_days = self.session_index.bots.get(bot_id, {})
+                for day, shard in manifest['shards'].get(bot_id, {}).items():
+                    for key in indexed_days.get(day, {}):
+                        self._plan[key] = shard
+        return self._plan
+
+    def fetch(self, s3_client, bucket_name, objects, cache=None, stats=None, max_workers=DEFAULT_MAX_WORKERS):
+        # (obj, body) for every object, like fetch_objects, but objects of compacted days come out
+        # of their day's shard with one read. Objects missing from the shard or changed since it was
+        # written, and everything without a shard (recent days, interim/), are fetched one by one.
+        if stats is None:
+            stats = FetchStats()
+        plan = self.plan
+        shard_sessions = 0
+        shards_read = 0
+        for shard_key, group in groupby(objects, key=lambda obj: plan.get(obj['Key'], {}).get('name')):
+            group = list(group)
+            if shard_key is None:
+                yield from fetch_objects(s3_client, bucket_name, group, max_workers, cache, stats)
+                continue
+
+            data = self.store.read_shard(plan[group[0]['Key']], cache, stats)
+            wanted = {obj['Key']: obj for obj in group}
+            if data is not None:
+                shards_read += 1
+                for shard_obj, body in iter_shard(data):
+                    obj = wanted.get(shard_obj['Key'])
+                    if obj is not None and obj.get('ETag') == shard_obj['ETag']:
+                        del wanted[obj['Key']]
+                        shard_sessions += 1
+                        yield obj, body
+
+            if wanted:
+                yield from fetch_objects(s3_client, bucket_name, list(wanted.values()), max_workers, cache,
+                                         stats)
+
+        if shards_read:
+            print(f'{shard_sessions} sessions read from {shards_read} shards')
+
+
+if __name__ == '__main__':
+    # Scheduled compaction: python session_shards.py [BOT_ID ...] (every indexed bot by default)
+    import sys
+    from s3_fetcher import get_s3_client
+    from session_index import load_session_index
+
+    s3_client = get_s3_client()
+    session_index = load_session_index(s3_client, 'core-session-prod', 'expired/')
+    compact_sessions(ShardStore(s3_client=s3_client), session_index, s3_client, 'core-session-prod',
+                     sys.argv[1:] or None)
@@ -0,0 +1,86 @@
+import json
+import sys
+import tempfile
+import zlib
+
+import pandas as pd
+from pandas.api.types import is_integer_dtype
+
+# Columns with few distinct values, kept as pandas categoricals (one code per row).
+# bot_id and the date columns are left as strings since reports group by them.
+CATEGORY_COLUMNS = ['account_id', 'referrer', 'bot_name']
+
+# Columns reports group by, with few distinct values. They stay plain object columns so
+# grouping is unchanged, but every row points at one shared copy of each value.
+SHARED_VALUE_COLUMNS = ['bot_id', 'created_at_date', 'created_at_date_central']
+
+# Counters that fit in a few bytes, downcast to the smallest int type holding their values
+SMALL_INT_COLUMNS = ['turns', 'fail_counter', 'max_consecutive_fails', 'created_at_hour_central']
+
+
+def compact_session_columns(df):
+    # Typed columns for a session frame, in place
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    for column in SHARED_VALUE_COLUMNS:
+        shared = {}
+        df[column] = pd.Series([shared.setdefault(value, value) for value in df[column]], index=df.index,
+                               dtype=object)
+    for column in SMALL_INT_COLUMNS:
+        # Counters decoded as floats stay floats, so the exports show the same values
+        if is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+
+class ComponentCatalog:
+    # Every distinct (component_id, component_name) entry is kept once and shared by all the
+    # sessions that returned it, instead of one dict per session and component
+
+    def __init__(self):
+        self.entries = {}
+
+    def intern(self, component_info):
+        return [self.entries.setdefault((entry.get('component_id'), entry.get('component_name')), entry)
+                for entry in component_info]
+
+
+class ConversationStore:
+    # Conversations of decoded sessions, compressed into a private temporary file and read back
+    # by row when an export needs them. The frame itself carries no conversations. Conversations
+    # are put in the frame's row order, so a row's index label is its position in the store;
+    # keyed by position rather than session_id, a session listed twice keeps both conversations.
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.offsets = []
+
+    def put(self, conversation):
+        data = zlib.compress(json.dumps(conversation).encode('utf-8'))
+        self.file.seek(0, 2)
+        self.offsets.append((self.file.tell(), len(data)))
+        self.file.write(data)
+
+    def get(self, position):
+        offset, size = self.offsets[position]
+        self.file.seek(offset)
+        conversation = json.loads(zlib.decompress(self.file.read(size)))
+        for entry in conversation:
+            if isinstance(entry.get('speaker'), str):
+                entry['speaker'] = sys.intern(entry['speaker'])
+        return conversation
+
+    def attach(self, df):
+        # Copy of df with its user_conversation column loaded back, in the original column order.
+        # df is the decoded frame or a selection of its rows with their index labels kept.
+        columns = list(df.columns)
+        columns.insert(columns.index('component_info'), 'user_conversation')
+        return df.assign(user_conversation=[self.get(position) for position in df.index])[columns]
+
+    def iter_attached(self, df, chunk_sessions):
+        # attach() for at most chunk_sessions rows at a time
+        for start in range(0, len(df), chunk_sessions):
+            yield self.attach(df.iloc[start:start + chunk_sessions])
+
+    def close(self):
+        self.file.close()
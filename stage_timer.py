@@ -0,0 +1,128 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+# How often resident memory is sampled while a stage runs
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+class _RssSampler(threading.Thread):
+    # Polls the process RSS in the background and keeps the highest value seen
+
+    def __init__(self, process):
+        super().__init__(daemon=True)
+        self.process = process
+        self.peak = process.memory_info().rss
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return self.peak
+
+
+class StageTimer:
+    # Records wall time, CPU time and peak RSS for each stage of a job.
+    # CPU time covers every thread of this process but not child processes.
+
+    def __init__(self, job_id=None, on_stage=None):
+        self.job_id = job_id
+        self.stages = []
+        self.process = psutil.Process()
+        self.started = time.perf_counter()
+        # Called with the stage name whenever a stage starts
+        self.on_stage = on_stage
+        self._totals = {}
+        # Job-level counters (objects with as_dict, e.g. S3 retry counts) added to the record by name
+        self.counters = {}
+        # Time charged through timed_iter, taken back out of the enclosing stage
+        self._charged = {'wall': 0.0, 'cpu': 0.0, 'stages': set()}
+
+    def _cpu_seconds(self):
+        # Process wide user + system time, cheap enough to read once per item in timed_iter
+        return time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        if self.on_stage is not None:
+            self.on_stage(name)
+
+        sampler = _RssSampler(self.process)
+        sampler.start()
+        charged_wall, charged_cpu = self._charged['wall'], self._charged['cpu']
+        self._charged['stages'] = set()
+        wall_started = time.perf_counter()
+        cpu_started = self._cpu_seconds()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_started - (self._charged['wall'] - charged_wall)
+            cpu = self._cpu_seconds() - cpu_started - (self._charged['cpu'] - charged_cpu)
+            peak_rss = sampler.stop()
+            self._add(name, wall, cpu, peak_rss)
+
+            # Overlapping stages share the enclosing stage's memory peak
+            for charged_stage in self._charged['stages']:
+                self._add(charged_stage, 0.0, 0.0, peak_rss)
+
+    def timed_iter(self, name, iterable):
+        # Charge the time spent producing each item of iterable to stage `name`, for stages
+        # that overlap with their consumer (e.g. downloads decoded as they arrive)
+        iterator = iter(iterable)
+        while True:
+            wall_started = time.perf_counter()
+            cpu_started = self._cpu_seconds()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._charge(name, time.perf_counter() - wall_started, self._cpu_seconds() - cpu_started)
+                return
+            self._charge(name, time.perf_counter() - wall_started, self._cpu_seconds() - cpu_started)
+            yield item
+
+    @contextmanager
+    def timed(self, name):
+        # Charge a block inside another stage to stage `name`, e.g. per-chunk aggregation
+        # while sessions are still being decoded
+        wall_started = time.perf_counter()
+        cpu_started = self._cpu_seconds()
+        try:
+            yield
+        finally:
+            self._charge(name, time.perf_counter() - wall_started, self._cpu_seconds() - cpu_started)
+
+    def _charge(self, name, wall, cpu):
+        self._charged['wall'] += wall
+        self._charged['cpu'] += cpu
+        self._charged['stages'].add(name)
+        self._add(name, wall, cpu, None)
+
+    def _add(self, name, wall, cpu, peak_rss):
+        if name not in self._totals:
+            self._totals[name] = {'stage': name, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None}
+            self.stages.append(self._totals[name])
+
+        totals = self._totals[name]
+        totals['wall_s'] += wall
+        totals['cpu_s'] += cpu
+        if peak_rss is not None:
+            peak_rss_mb = peak_rss / (1024 * 1024)
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'] or 0, peak_rss_mb)
+
+    def record(self):
+        # Structured timing record of the whole job
+        return {
+            'job_id': self.job_id,
+            'total_wall_s': round(time.perf_counter() - self.started, 3),
+            'stages': [{'stage': s['stage'], 'wall_s': round(s['wall_s'], 3), 'cpu_s': round(s['cpu_s'], 3),
+                        'peak_rss_mb': round(s['peak_rss_mb'], 1) if s['peak_rss_mb'] is not None else None}
+                       for s in self.stages],
+            **{name: counter.as_dict() for name, counter in self.counters.items()},
+        }